@@ -9,7 +9,7 @@ class DatasetLoader:
     def __init__(self, db_path=DB_PATH):
         self.db_path = db_path
 
-    def load_features(self, label_column="cognitive_load_status", test_size=0.2, random_state=42):
+    def load_features(self, label_column="cognitive_load_status", test_size=0.2, random_state=42, return_groups=False):
         query = f"""
         SELECT
             tf.power_tfr_morlet,
@@ -34,6 +34,7 @@ class DatasetLoader:
             sf.skewness,
             sf.snr,
             sf.spike_count,
+            s.participant_id,
             s.{label_column}
         FROM
             tfr_features AS tf
@@ -62,7 +63,8 @@ class DatasetLoader:
         if labels.isnull().any():
             raise ValueError("Label column contains values outside of the expected range ('PRE', 'POST').")
 
-        columns_to_drop = [label_column, "recording_filename", "channel", "band", "session_id"]
+        groups = data["participant_id"]
+        columns_to_drop = [label_column, "recording_filename", "channel", "band", "session_id", "participant_id"]
         features = data.drop(columns=[col for col in columns_to_drop if col in data.columns])
 
         print("Features (first 5 rows):")
@@ -91,10 +93,12 @@ class DatasetLoader:
         else:
             print("No columns selected for normalization.")
 
-        X_train, X_test, y_train, y_test = train_test_split(
-            features, labels, test_size=test_size, random_state=random_state
+        X_train, X_test, y_train, y_test, groups_train, groups_test = train_test_split(
+            features, labels, groups, test_size=test_size, random_state=random_state
         )
 
         print(f"X_train shape: {X_train.shape}, X_test shape: {X_test.shape}")
         print(f"y_train shape: {y_train.shape}, y_test shape: {y_test.shape}")
+        if return_groups:
+            return X_train, X_test, y_train, y_test, groups_train, groups_test
         return X_train, X_test, y_train, y_test
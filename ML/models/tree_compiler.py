@@ -0,0 +1,326 @@
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class CompiledTreeEnsemble:
+    # All trees share one set of flat node arrays. The right child of a split is
+    # always stored directly after its left child, and leaves are encoded as
+    # splits that can never go right and point back to themselves, so a fixed
+    # number of steps (the depth of the deepest tree) brings every (row, tree)
+    # pair to its leaf without any per-node branching.
+    small_batch_rows = 8
+
+    def __init__(
+        self,
+        feature,
+        threshold,
+        left,
+        value,
+        default_left,
+        roots,
+        base_score=0.0,
+        aggregation="sum",
+        link="sigmoid",
+        sigmoid_scale=1.0,
+        strict=False,
+        input_dtype="float64",
+        n_features=None,
+    ):
+        self.feature = np.asarray(feature, dtype=np.intp)
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        self.left = np.asarray(left, dtype=np.intp)
+        self.value = np.asarray(value, dtype=np.float64)
+        self.default_left = np.asarray(default_left, dtype=bool)
+        self.roots = np.asarray(roots, dtype=np.intp)
+        self.base_score = float(base_score)
+        self.aggregation = aggregation
+        self.link = link
+        self.sigmoid_scale = float(sigmoid_scale)
+        self.strict = bool(strict)
+        self.input_dtype = np.dtype(input_dtype)
+        self.n_features = n_features
+        self.max_depth = self._compute_max_depth()
+        self._threshold = self.threshold.astype(self.input_dtype)
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    @property
+    def n_nodes(self):
+        return len(self.feature)
+
+    def _compute_max_depth(self):
+        depth = 0
+        nodes = self.roots
+        while True:
+            internal = nodes[self.left[nodes] != nodes]
+            if internal.size == 0:
+                return depth
+            nodes = np.concatenate([self.left[internal], self.left[internal] + 1])
+            depth += 1
+
+    def _go_right(self, fvalue, threshold, default_left):
+        go_right = fvalue >= threshold if self.strict else fvalue > threshold
+        missing = np.isnan(fvalue)
+        if missing.any():
+            go_right = np.where(missing, ~default_left, go_right)
+        return go_right
+
+    def _leaf_indices(self, X):
+        X = np.asarray(X, dtype=self.input_dtype)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+
+        if X.shape[0] <= self.small_batch_rows:
+            # For a handful of rows it is cheaper to resolve every split once
+            # and then follow the successor table level by level.
+            go_right = self._go_right(X.take(self.feature, axis=1), self._threshold, self.default_left)
+            successor = self.left + go_right
+            leaves = np.empty((X.shape[0], self.n_trees), dtype=np.intp)
+            for row in range(X.shape[0]):
+                nodes = self.roots
+                row_successor = successor[row]
+                for _ in range(self.max_depth):
+                    nodes = row_successor[nodes]
+                leaves[row] = nodes
+            return leaves
+
+        rows = np.arange(X.shape[0])[:, np.newaxis]
+        nodes = np.repeat(self.roots[np.newaxis, :], X.shape[0], axis=0)
+        for _ in range(self.max_depth):
+            fvalue = X[rows, self.feature[nodes]]
+            nodes = self.left[nodes] + self._go_right(fvalue, self._threshold[nodes], self.default_left[nodes])
+        return nodes
+
+    def decision_function(self, X):
+        leaf_values = self.value[self._leaf_indices(X)]
+        if self.aggregation == "mean":
+            return self.base_score + leaf_values.mean(axis=1)
+        return self.base_score + leaf_values.sum(axis=1)
+
+    def predict_proba(self, X):
+        score = self.decision_function(X)
+        if self.link == "sigmoid":
+            return 1.0 / (1.0 + np.exp(-self.sigmoid_scale * score))
+        return score
+
+    def predict(self, X, threshold=0.5):
+        return (self.predict_proba(X) > threshold).astype(int)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez(
+            path,
+            feature=self.feature.astype(np.int32),
+            threshold=self.threshold,
+            left=self.left.astype(np.int32),
+            value=self.value,
+            default_left=self.default_left,
+            roots=self.roots.astype(np.int32),
+            meta=json.dumps({
+                "base_score": self.base_score,
+                "aggregation": self.aggregation,
+                "link": self.link,
+                "sigmoid_scale": self.sigmoid_scale,
+                "strict": self.strict,
+                "input_dtype": self.input_dtype.name,
+                "n_features": self.n_features,
+            }),
+        )
+        logger.info(f"Compiled ensemble ({self.n_trees} trees, {self.n_nodes} nodes) saved to {path}")
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            meta = json.loads(str(arrays["meta"]))
+            return cls(
+                arrays["feature"],
+                arrays["threshold"],
+                arrays["left"],
+                arrays["value"],
+                arrays["default_left"],
+                arrays["roots"],
+                **meta,
+            )
+
+
+class _NodeBuffer:
+    def __init__(self):
+        self.feature = []
+        self.threshold = []
+        self.left = []
+        self.value = []
+        self.default_left = []
+        self.roots = []
+
+    def _add_leaf(self, value=0.0):
+        index = len(self.feature)
+        self.feature.append(0)
+        self.threshold.append(np.inf)
+        self.left.append(index)
+        self.value.append(value)
+        self.default_left.append(True)
+        return index
+
+    def add_tree(self, root, describe):
+        # describe(node) returns ("leaf", value) or
+        # ("split", feature, threshold, default_left, left_node, right_node).
+        self.roots.append(self._add_leaf())
+        stack = [(root, self.roots[-1])]
+        while stack:
+            node, index = stack.pop()
+            kind, *fields = describe(node)
+            if kind == "leaf":
+                self.value[index] = float(fields[0])
+                continue
+            feature, threshold, default_left, left_node, right_node = fields
+            left = self._add_leaf()
+            right = self._add_leaf()
+            self.feature[index] = int(feature)
+            self.threshold[index] = float(threshold)
+            self.default_left[index] = bool(default_left)
+            self.left[index] = left
+            stack.append((left_node, left))
+            stack.append((right_node, right))
+
+    def build(self, **kwargs):
+        return CompiledTreeEnsemble(
+            self.feature,
+            self.threshold,
+            self.left,
+            self.value,
+            self.default_left,
+            self.roots,
+            **kwargs,
+        )
+
+
+def compile_lightgbm(booster):
+    dump = booster.dump_model()
+    objective = dump.get("objective", "")
+    if not objective.startswith("binary"):
+        raise ValueError(f"Only binary LightGBM models can be compiled, got objective '{objective}'.")
+    sigmoid_scale = 1.0
+    for token in objective.split():
+        if token.startswith("sigmoid:"):
+            sigmoid_scale = float(token.split(":", 1)[1])
+
+    def describe(node):
+        if "split_feature" not in node:
+            return "leaf", node["leaf_value"]
+        if node.get("decision_type", "<=") != "<=":
+            raise ValueError("Categorical LightGBM splits are not supported by the compiled predictor.")
+        threshold = float(node["threshold"])
+        missing_type = node.get("missing_type", "None")
+        if missing_type == "NaN":
+            default_left = node.get("default_left", True)
+        elif missing_type == "None":
+            # LightGBM maps NaN to 0.0 when the feature had no missing values in training.
+            default_left = 0.0 <= threshold
+        else:
+            raise ValueError(f"LightGBM missing_type '{missing_type}' is not supported by the compiled predictor.")
+        return "split", node["split_feature"], threshold, default_left, node["left_child"], node["right_child"]
+
+    buffer = _NodeBuffer()
+    for tree_info in dump["tree_info"]:
+        buffer.add_tree(tree_info["tree_structure"], describe)
+
+    return buffer.build(
+        aggregation="mean" if dump.get("average_output", False) else "sum",
+        link="sigmoid",
+        sigmoid_scale=sigmoid_scale,
+        strict=False,
+        input_dtype="float64",
+        n_features=dump.get("max_feature_idx", -1) + 1,
+    )
+
+
+def compile_xgboost(booster):
+    model = json.loads(booster.save_raw(raw_format="json"))
+    learner = model["learner"]
+    objective = learner["objective"]["name"]
+    if objective != "binary:logistic":
+        raise ValueError(f"Only binary:logistic XGBoost models can be compiled, got '{objective}'.")
+    base_score = float(str(learner["learner_model_param"]["base_score"]).strip("[]"))
+
+    buffer = _NodeBuffer()
+    for tree in learner["gradient_booster"]["model"]["trees"]:
+        def describe(node, tree=tree):
+            if tree["left_children"][node] == -1:
+                # XGBoost stores leaf weights in split_conditions.
+                return "leaf", tree["split_conditions"][node]
+            return (
+                "split",
+                tree["split_indices"][node],
+                tree["split_conditions"][node],
+                tree["default_left"][node],
+                tree["left_children"][node],
+                tree["right_children"][node],
+            )
+
+        buffer.add_tree(0, describe)
+
+    return buffer.build(
+        base_score=np.log(base_score / (1.0 - base_score)),
+        aggregation="sum",
+        link="sigmoid",
+        strict=True,
+        input_dtype="float32",
+        n_features=int(learner["learner_model_param"]["num_feature"]),
+    )
+
+
+def compile_random_forest(forest):
+    if forest.n_classes_ != 2:
+        raise ValueError("Only binary RandomForestClassifier models can be compiled.")
+
+    buffer = _NodeBuffer()
+    for estimator in forest.estimators_:
+        tree = estimator.tree_
+        class_weights = tree.value[:, 0, :]
+        positive = class_weights[:, 1] / class_weights.sum(axis=1)
+
+        def describe(node, tree=tree, positive=positive):
+            if tree.children_left[node] == -1:
+                return "leaf", positive[node]
+            return (
+                "split",
+                tree.feature[node],
+                tree.threshold[node],
+                True,
+                tree.children_left[node],
+                tree.children_right[node],
+            )
+
+        buffer.add_tree(0, describe)
+
+    return buffer.build(
+        aggregation="mean",
+        link="identity",
+        strict=False,
+        input_dtype="float32",
+        n_features=forest.n_features_in_,
+    )
+
+
+def compile_ensemble(model):
+    model_type = type(model).__name__
+    module = type(model).__module__.split(".")[0]
+    if module == "lightgbm" and model_type == "Booster":
+        return compile_lightgbm(model)
+    if module == "xgboost" and model_type == "Booster":
+        return compile_xgboost(model)
+    if model_type == "RandomForestClassifier":
+        return compile_random_forest(model)
+    raise ValueError(f"Model type '{model_type}' cannot be compiled to a tree ensemble.")
+
+
+def max_prediction_difference(compiled, reference_proba, X):
+    difference = np.abs(compiled.predict_proba(X) - np.asarray(reference_proba, dtype=np.float64))
+    return float(difference.max()) if difference.size else 0.0
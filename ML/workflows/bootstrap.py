@@ -0,0 +1,100 @@
+import numpy as np
+
+BOOTSTRAP_METRICS = ["accuracy", "f1_score", "roc_auc"]
+
+
+def resample_weights(n_samples, n_resamples, rng, groups=None):
+    # Draw the bootstrap index matrix and turn it into per-sample multiplicities,
+    # so every metric below is a weighted sum over the original arrays.
+    if groups is None:
+        idx = rng.integers(0, n_samples, size=(n_resamples, n_samples))
+        offsets = (np.arange(n_resamples) * n_samples)[:, np.newaxis]
+        counts = np.bincount((idx + offsets).ravel(), minlength=n_resamples * n_samples)
+        return counts.reshape(n_resamples, n_samples).astype(np.float64)
+
+    unique_groups, group_index = np.unique(groups, return_inverse=True)
+    n_groups = len(unique_groups)
+    idx = rng.integers(0, n_groups, size=(n_resamples, n_groups))
+    offsets = (np.arange(n_resamples) * n_groups)[:, np.newaxis]
+    group_counts = np.bincount((idx + offsets).ravel(), minlength=n_resamples * n_groups)
+    group_counts = group_counts.reshape(n_resamples, n_groups).astype(np.float64)
+    return group_counts[:, group_index]
+
+
+def weighted_accuracy(weights, correct):
+    return weights @ correct / weights.sum(axis=1)
+
+
+def weighted_f1(weights, y_true, y_pred):
+    tp = weights @ (y_true & y_pred).astype(np.float64)
+    fp = weights @ (~y_true & y_pred).astype(np.float64)
+    fn = weights @ (y_true & ~y_pred).astype(np.float64)
+    denominator = 2 * tp + fp + fn
+    return np.divide(2 * tp, denominator, out=np.zeros_like(tp), where=denominator > 0)
+
+
+def tie_blocks(sorted_scores):
+    return np.flatnonzero(np.r_[True, sorted_scores[1:] != sorted_scores[:-1]])
+
+
+def weighted_rank_auc(weights, sorted_true, block_starts):
+    # Mann-Whitney statistic on weighted samples already sorted by score: every
+    # positive counts the weight of negatives ranked below it plus half of the
+    # negatives tied with it.
+    positive = weights * sorted_true
+    negative = weights - positive
+    if len(block_starts) < weights.shape[1]:
+        positive = np.add.reduceat(positive, block_starts, axis=1)
+        negative = np.add.reduceat(negative, block_starts, axis=1)
+    negatives_below = np.cumsum(negative, axis=1) - negative
+    pairs = (positive * (negatives_below + 0.5 * negative)).sum(axis=1)
+
+    total = positive.sum(axis=1) * negative.sum(axis=1)
+    return np.divide(pairs, total, out=np.full_like(pairs, np.nan), where=total > 0)
+
+
+def bootstrap_confidence_intervals(
+    y_true,
+    y_pred,
+    y_score=None,
+    groups=None,
+    n_bootstrap=2000,
+    ci_level=0.95,
+    random_state=42,
+    max_cells_per_chunk=5_000_000,
+):
+    y_true = np.asarray(y_true).astype(bool)
+    y_pred = np.asarray(y_pred).astype(bool)
+    groups = None if groups is None else np.asarray(groups)
+    n_samples = len(y_true)
+    if y_score is not None:
+        # Resampling does not depend on sample order, so sort once by score and
+        # let every replicate reuse the same tie blocks.
+        y_score = np.asarray(y_score, dtype=np.float64)
+        order = np.argsort(y_score, kind="mergesort")
+        y_true, y_pred, y_score = y_true[order], y_pred[order], y_score[order]
+        groups = None if groups is None else groups[order]
+        block_starts = tie_blocks(y_score)
+    correct = (y_true == y_pred).astype(np.float64)
+
+    rng = np.random.default_rng(random_state)
+    chunk_size = max(1, max_cells_per_chunk // max(n_samples, 1))
+    replicates = {metric: [] for metric in BOOTSTRAP_METRICS}
+    for start in range(0, n_bootstrap, chunk_size):
+        weights = resample_weights(n_samples, min(chunk_size, n_bootstrap - start), rng, groups)
+        replicates["accuracy"].append(weighted_accuracy(weights, correct))
+        replicates["f1_score"].append(weighted_f1(weights, y_true, y_pred))
+        if y_score is not None:
+            replicates["roc_auc"].append(weighted_rank_auc(weights, y_true, block_starts))
+
+    alpha = (1 - ci_level) / 2
+    intervals = {}
+    for metric, values in replicates.items():
+        if not values:
+            continue
+        values = np.concatenate(values)
+        if np.isnan(values).all():
+            continue
+        lower, upper = np.nanquantile(values, [alpha, 1 - alpha])
+        intervals[metric] = {"lower": float(lower), "upper": float(upper), "std": float(np.nanstd(values))}
+    return intervals
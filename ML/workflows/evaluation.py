@@ -8,16 +8,67 @@ from sklearn.metrics import (
     confusion_matrix,
     classification_report,
     roc_curve,
+    auc,
 )
+from ML.workflows.bootstrap import bootstrap_confidence_intervals
+from concurrent.futures import ProcessPoolExecutor
+from joblib import Parallel, delayed
+import numpy as np
 import logging
-import matplotlib.pyplot as plt
-import seaborn as sns
 import os
 import json
+import tempfile
+
+
+def render_evaluation_plots(plot_data_path, report_dir, model_name):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    plot_paths = []
+    with np.load(plot_data_path) as data:
+        if "confusion_matrix" in data:
+            plt.figure(figsize=(8, 6))
+            sns.heatmap(data["confusion_matrix"], annot=True, fmt="d", cmap="Blues", cbar=False)
+            plt.xlabel("Predicted")
+            plt.ylabel("Actual")
+            plt.title("Confusion Matrix")
+            plot_path = os.path.join(report_dir, f"{model_name}_confusion_matrix.png")
+            plt.savefig(plot_path)
+            plt.close()
+            plot_paths.append(plot_path)
+
+        if "fpr" in data:
+            plt.figure()
+            plt.plot(data["fpr"], data["tpr"], label="ROC curve (area = {:.2f})".format(float(data["roc_auc"])))
+            plt.plot([0, 1], [0, 1], "k--", label="Random guess")
+            plt.xlabel("False Positive Rate")
+            plt.ylabel("True Positive Rate")
+            plt.title("ROC Curve")
+            plt.legend(loc="best")
+            plot_path = os.path.join(report_dir, f"{model_name}_roc_curve.png")
+            plt.savefig(plot_path)
+            plt.close()
+            plot_paths.append(plot_path)
+    return plot_paths
+
+
+def permuted_group_scores(predict_fn, X, y_true, columns, n_repeats, seed):
+    # X is shared read-only between workers; each task works on one private copy
+    # and only rewrites the columns of its own feature group.
+    rng = np.random.default_rng(seed)
+    X_permuted = np.array(X)
+    scores = []
+    for _ in range(n_repeats):
+        permutation = rng.permutation(X.shape[0])
+        X_permuted[:, columns] = X[np.ix_(permutation, columns)]
+        scores.append(roc_auc_score(y_true, predict_fn(X_permuted)))
+    return scores
 
 
 class ModelEvaluator:
-    def __init__(self, evaluation_options=None, report_dir="reports"):
+    def __init__(self, evaluation_options=None, report_dir="reports", metrics_only=False):
         self.logger = logging.getLogger(__name__)
         logging.basicConfig(level=logging.INFO)
         self.report_dir = report_dir
@@ -34,7 +85,22 @@ class ModelEvaluator:
             "classification_report": False,
             "plot_confusion_matrix": True,
             "plot_roc_curve": True,
+            "async_plots": True,
+            "bootstrap_ci": True,
+            "n_bootstrap": 2000,
+            "ci_level": 0.95,
+            "n_permutation_repeats": 5,
+            "permutation_max_samples": 20000,
+            "n_jobs": -1,
         }
+        if metrics_only:
+            self.evaluation_options = {
+                **self.evaluation_options,
+                "plot_confusion_matrix": False,
+                "plot_roc_curve": False,
+            }
+        self._plot_executor = None
+        self._plot_futures = []
 
     def evaluate_model(
         self,
@@ -45,6 +111,7 @@ class ModelEvaluator:
         feature_importances=None,
         feature_names=None,
         model_name="model",
+        groups=None,
     ):
         metrics = {}
 
@@ -57,10 +124,18 @@ class ModelEvaluator:
         if self.evaluation_options.get("f1_score", True):
             metrics["f1_score"] = f1_score(y_true, y_pred, average=average, zero_division=0)
 
+        plot_data = {}
         if y_pred_proba is not None:
-            if self.evaluation_options.get("roc_auc", True):
+            if self.evaluation_options.get("roc_auc", True) or self.evaluation_options.get("plot_roc_curve", True):
                 try:
-                    metrics["roc_auc"] = roc_auc_score(y_true, y_pred_proba, multi_class="ovr", average=average)
+                    if average == "binary":
+                        fpr, tpr, _ = roc_curve(y_true, y_pred_proba)
+                        roc_auc = auc(fpr, tpr)
+                        plot_data.update(fpr=fpr, tpr=tpr, roc_auc=roc_auc)
+                    else:
+                        roc_auc = roc_auc_score(y_true, y_pred_proba, multi_class="ovr", average=average)
+                    if self.evaluation_options.get("roc_auc", True):
+                        metrics["roc_auc"] = roc_auc
                 except ValueError:
                     self.logger.warning("ROC AUC could not be computed. Check inputs for compatibility.")
             if self.evaluation_options.get("log_loss", True):
@@ -73,10 +148,30 @@ class ModelEvaluator:
             cm = confusion_matrix(y_true, y_pred)
             metrics["confusion_matrix"] = cm.tolist()
             if self.evaluation_options.get("plot_confusion_matrix", True):
-                self._plot_confusion_matrix(cm, model_name)
+                plot_data["confusion_matrix"] = cm
 
-        if self.evaluation_options.get("plot_roc_curve", True) and y_pred_proba is not None:
-            self._plot_roc_curve(y_true, y_pred_proba, model_name)
+        if not self.evaluation_options.get("plot_roc_curve", True):
+            for key in ("fpr", "tpr", "roc_auc"):
+                plot_data.pop(key, None)
+        if plot_data:
+            self._schedule_plots(plot_data, model_name)
+
+        if self.evaluation_options.get("bootstrap_ci", True) and average == "binary":
+            n_bootstrap = self.evaluation_options.get("n_bootstrap", 2000)
+            ci_level = self.evaluation_options.get("ci_level", 0.95)
+            metrics["confidence_intervals"] = bootstrap_confidence_intervals(
+                y_true,
+                y_pred,
+                y_score=y_pred_proba,
+                groups=groups,
+                n_bootstrap=n_bootstrap,
+                ci_level=ci_level,
+            )
+            metrics["bootstrap"] = {
+                "n_bootstrap": n_bootstrap,
+                "ci_level": ci_level,
+                "grouped": groups is not None,
+            }
 
         if self.evaluation_options.get("classification_report", False):
             metrics["classification_report"] = classification_report(y_true, y_pred, zero_division=0)
@@ -98,30 +193,101 @@ class ModelEvaluator:
 
         return metrics
 
-    def _plot_confusion_matrix(self, cm, model_name):
-        plt.figure(figsize=(8, 6))
-        sns.heatmap(cm, annot=True, fmt="d", cmap="Blues", cbar=False)
-        plt.xlabel("Predicted")
-        plt.ylabel("Actual")
-        plt.title("Confusion Matrix")
-        plot_path = os.path.join(self.report_dir, f"{model_name}_confusion_matrix.png")
-        plt.savefig(plot_path)
-        plt.close()
-        self.logger.info(f"Saved confusion matrix plot to {plot_path}")
-
-    def _plot_roc_curve(self, y_true, y_pred_proba, model_name):
-        fpr, tpr, _ = roc_curve(y_true, y_pred_proba)
-        plt.figure()
-        plt.plot(fpr, tpr, label="ROC curve (area = {:.2f})".format(roc_auc_score(y_true, y_pred_proba)))
-        plt.plot([0, 1], [0, 1], "k--", label="Random guess")
-        plt.xlabel("False Positive Rate")
-        plt.ylabel("True Positive Rate")
-        plt.title("ROC Curve")
-        plt.legend(loc="best")
-        plot_path = os.path.join(self.report_dir, f"{model_name}_roc_curve.png")
-        plt.savefig(plot_path)
-        plt.close()
-        self.logger.info(f"Saved ROC curve plot to {plot_path}")
+    def _schedule_plots(self, plot_data, model_name):
+        # The arrays go to a temporary file outside the report directory and
+        # are deleted once the plots have been rendered.
+        fd, plot_data_path = tempfile.mkstemp(prefix=f"{model_name}_plot_data_", suffix=".npz")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **plot_data)
+        if not self.evaluation_options.get("async_plots", True):
+            try:
+                for plot_path in render_evaluation_plots(plot_data_path, self.report_dir, model_name):
+                    self.logger.info(f"Saved plot to {plot_path}")
+            finally:
+                os.remove(plot_data_path)
+            return
+        if self._plot_executor is None:
+            self._plot_executor = ProcessPoolExecutor(max_workers=1)
+        future = self._plot_executor.submit(render_evaluation_plots, plot_data_path, self.report_dir, model_name)
+        self._plot_futures.append((model_name, future, plot_data_path))
+        self.logger.info(f"Queued plots for {model_name}")
+
+    def wait_for_plots(self):
+        plot_paths = []
+        for model_name, future, plot_data_path in self._plot_futures:
+            try:
+                for plot_path in future.result():
+                    self.logger.info(f"Saved plot to {plot_path}")
+                    plot_paths.append(plot_path)
+            except Exception as e:
+                self.logger.error(f"Rendering plots for {model_name} failed: {e}")
+            finally:
+                os.remove(plot_data_path)
+        self._plot_futures = []
+        if self._plot_executor is not None:
+            self._plot_executor.shutdown()
+            self._plot_executor = None
+        return plot_paths
+
+    def evaluate_permutation_importance(
+        self,
+        predict_fn,
+        X,
+        y_true,
+        feature_names,
+        model_name="model",
+        base_proba=None,
+        feature_groups=None,
+        random_state=42,
+    ):
+        X = np.asarray(X, dtype=np.float64)
+        y_true = np.asarray(y_true)
+        n_repeats = self.evaluation_options.get("n_permutation_repeats", 5)
+        max_samples = self.evaluation_options.get("permutation_max_samples", 20000)
+        n_jobs = self.evaluation_options.get("n_jobs", -1)
+
+        rng = np.random.default_rng(random_state)
+        if max_samples and X.shape[0] > max_samples:
+            rows = np.sort(rng.choice(X.shape[0], size=max_samples, replace=False))
+            X, y_true = X[rows], y_true[rows]
+            base_proba = None if base_proba is None else np.asarray(base_proba)[rows]
+        if base_proba is None:
+            base_proba = predict_fn(X)
+        base_score = roc_auc_score(y_true, base_proba)
+
+        groups = {}
+        grouped_columns = set()
+        for group_name, columns in (feature_groups or {}).items():
+            indices = [feature_names.index(column) for column in columns if column in feature_names]
+            if indices:
+                groups[group_name] = indices
+                grouped_columns.update(indices)
+        for index, feature in enumerate(feature_names):
+            if index not in grouped_columns:
+                groups[feature] = [index]
+
+        self.logger.info(
+            f"Permutation importance for {model_name}: {len(groups)} feature groups, "
+            f"{n_repeats} repeats, {X.shape[0]} rows, base ROC AUC {base_score:.4f}"
+        )
+        seeds = rng.integers(0, 2**31 - 1, size=len(groups))
+        group_scores = Parallel(n_jobs=n_jobs, mmap_mode="r")(
+            delayed(permuted_group_scores)(predict_fn, X, y_true, columns, n_repeats, seed)
+            for columns, seed in zip(groups.values(), seeds)
+        )
+
+        import pandas as pd
+        drops = base_score - np.asarray(group_scores)
+        df = pd.DataFrame({
+            "Feature": list(groups.keys()),
+            "Columns": [";".join(feature_names[i] for i in columns) for columns in groups.values()],
+            "Importance": drops.mean(axis=1),
+            "Std": drops.std(axis=1),
+        }).sort_values(by="Importance", ascending=False)
+        file_path = os.path.join(self.report_dir, f"{model_name}_permutation_importances.csv")
+        df.to_csv(file_path, index=False)
+        self.logger.info(f"Saved permutation importances to {file_path}")
+        return df
 
     def _log_feature_importances(self, importances, feature_names, model_name):
         feature_importances = sorted(
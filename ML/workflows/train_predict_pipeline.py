@@ -1,9 +1,11 @@
 from ML.dataset_loader import DatasetLoader
 from ML.workflows.evaluation import ModelEvaluator
+from ML.models.tree_compiler import compile_ensemble, max_prediction_difference
 from sklearn.linear_model import LogisticRegression
 from sklearn.ensemble import RandomForestClassifier
 import lightgbm as lgb
 import xgboost as xgb
+from functools import partial
 import pickle
 import os
 import logging
@@ -14,6 +16,13 @@ logger = logging.getLogger(__name__)
 
 DB_PATH = "data/neuroinsights.db"
 REPORT_DIR = "reports"
+COMPILED_MODELS = ["random_forest", "lightgbm", "xgboost"]
+# Largest |p_compiled - p_native| accepted before a compiled model is exported.
+COMPILED_PARITY_TOLERANCE = 1e-6
+FEATURE_GROUPS = {
+    "spectral_band_power": ["power_tfr_morlet", "power_psd_welch", "band_power", "relative_power"],
+    "hjorth": ["hjorth_activity", "hjorth_mobility", "hjorth_complexity"],
+}
 
 
 class GradientBoostingModels:
@@ -68,11 +77,46 @@ class GradientBoostingModels:
             logger.error(f"Failed to load {model_name}: {e}")
 
 
-def train_and_evaluate(models_to_train):
+def positive_class_proba(model, X):
+    return model.predict_proba(X)[:, 1]
+
+
+def lightgbm_proba(booster, X):
+    return booster.predict(X)
+
+
+def xgboost_proba(booster, feature_names, X):
+    return booster.predict(xgb.DMatrix(X, feature_names=feature_names))
+
+
+def export_compiled_model(model, model_name, models_dir, X_reference, reference_proba):
+    try:
+        compiled = compile_ensemble(model)
+    except ValueError as e:
+        logger.warning(f"Skipping compiled export for {model_name}: {e}")
+        return None
+    compiled_path = f"{models_dir}/{model_name}_compiled.npz"
+    difference = max_prediction_difference(compiled, reference_proba, X_reference.to_numpy())
+    logger.info(f"Compiled {model_name}: max |p_compiled - p_native| = {difference:.3e} on {len(X_reference)} rows.")
+    if not difference <= COMPILED_PARITY_TOLERANCE:
+        # A compiled model left over from an earlier training run would no
+        # longer match the native one either, so it is removed as well.
+        logger.error(
+            f"Skipping compiled export for {model_name}: predictions differ from the native model by "
+            f"{difference:.3e} (tolerance {COMPILED_PARITY_TOLERANCE:.0e})."
+        )
+        if os.path.exists(compiled_path):
+            os.remove(compiled_path)
+        return None
+    compiled.save(compiled_path)
+    return compiled
+
+
+def train_and_evaluate(models_to_train, plots=True, permutation_importance=True):
     loader = DatasetLoader(DB_PATH)
-    X_train, X_test, y_train, y_test = loader.load_features()
+    X_train, X_test, y_train, y_test, _, groups_test = loader.load_features(return_groups=True)
 
-    evaluator = ModelEvaluator(report_dir=REPORT_DIR)
+    evaluator = ModelEvaluator(report_dir=REPORT_DIR, metrics_only=not plots)
     models_dir = "models"
     os.makedirs(models_dir, exist_ok=True)
 
@@ -117,6 +161,11 @@ def train_and_evaluate(models_to_train):
                 model.feature_importances_ if hasattr(model, "feature_importances_") else None
             )
 
+        compiled_model = None
+        if model_name in COMPILED_MODELS:
+            trained_model = gb_models.models[model_name] if model_name in gb_models.models else traditional_models[model_name]
+            compiled_model = export_compiled_model(trained_model, model_name, models_dir, X_test, predictions_proba)
+
         logger.info(f"Evaluating {model_name}...")
         metrics = evaluator.evaluate_model(
             y_true=y_test,
@@ -126,9 +175,37 @@ def train_and_evaluate(models_to_train):
             feature_importances=feature_importances,
             feature_names=feature_names,
             model_name=model_name,
+            groups=groups_test.to_numpy(),
         )
         logger.info(f"Metrics for {model_name}: {metrics}")
 
+        if permutation_importance and predictions_proba is not None:
+            # The compiled model is fastest; without one (export skipped or
+            # not supported) the native model is used.
+            if compiled_model is not None:
+                predict_fn = compiled_model.predict_proba
+            elif model_name in traditional_models:
+                predict_fn = partial(positive_class_proba, traditional_models[model_name])
+            elif model_name == "lightgbm":
+                predict_fn = partial(lightgbm_proba, gb_models.models["lightgbm"])
+            elif model_name == "xgboost":
+                predict_fn = partial(xgboost_proba, gb_models.models["xgboost"], feature_names)
+            else:
+                predict_fn = None
+            if predict_fn is None:
+                logger.warning(f"Skipping permutation importance for {model_name}: no prediction function.")
+            else:
+                evaluator.evaluate_permutation_importance(
+                    predict_fn,
+                    X_test.to_numpy(),
+                    y_test.to_numpy(),
+                    feature_names,
+                    model_name=model_name,
+                    base_proba=predictions_proba,
+                    feature_groups=FEATURE_GROUPS,
+                )
+
+    evaluator.wait_for_plots()
 
 
 if __name__ == "__main__":
@@ -139,5 +216,9 @@ if __name__ == "__main__":
         default=["logistic_regression", "random_forest", "lightgbm", "xgboost"],
         help="Specify models to train (default: all).",
     )
+    parser.add_argument("--no-plots", action="store_true", help="Compute metrics only, skip report figures.")
+    parser.add_argument(
+        "--no-permutation-importance", action="store_true", help="Skip permutation feature importance."
+    )
     args = parser.parse_args()
-    train_and_evaluate(args.models)
+    train_and_evaluate(args.models, plots=not args.no_plots, permutation_importance=not args.no_permutation_importance)
@@ -1,56 +1,167 @@
 import os
 import argparse
+import json
+import concurrent.futures
+import multiprocessing
+import time
 from pathlib import Path
 from beamforming.beamformer import Beamformer
+from beamforming.covariance import streaming_covariance
+from beamforming.roi_projection import iter_roi_chunks
+from utils.concurrency import configure_worker, plan_parallelism
 from utils.logger_manager import LoggerManager
-from utils.results_saver import save_to_npy, save_to_hdf5
+from utils.results_saver import array_writer
 import mne
-from joblib import Parallel, delayed
 import csv
 
 logger = LoggerManager.get_logger("BatchProcessor")
 
-def save_results(data, filepath, save_as_hdf5=False, metadata=None):
-    if save_as_hdf5:
-        save_to_hdf5(data, filepath.with_suffix(".hdf5"), metadata)
-    else:
-        save_to_npy(data, filepath.with_suffix(".npy"))
+# Beamformer of a batch worker, set up once by init_worker and reused for
+# every recording the worker processes.
+_worker_beamformer = None
+
+# What the saved ROI time courses mean. Results of older runs (free
+# orientation magnitudes, mode="mean", threshold reg) have no sidecar or a
+# different version, and are recomputed instead of being resumed.
+RESULT_VERSION = "lcmv-normal-mean_flip-oas"
+
+
+def output_path_for(edf_file, output_dir, save_as_hdf5=False):
+    output_path = Path(output_dir) / f"{Path(edf_file).stem}_stc_atlas"
+    return output_path.with_suffix(".hdf5" if save_as_hdf5 else ".npy")
+
+
+def sidecar_path(output_path):
+    return output_path.with_name(f"{output_path.name}.json")
+
+
+def write_sidecar(output_path, metadata):
+    # Written after the data file, so its presence also marks the result as
+    # complete; .npy results carry their metadata here.
+    path = sidecar_path(output_path)
+    partial = path.with_name(f"partial_{os.getpid()}_{path.name}")
+    with open(partial, "w") as f:
+        json.dump(metadata, f)
+    os.replace(partial, path)
+
+
+def is_current_result(output_path):
+    try:
+        with open(sidecar_path(output_path)) as f:
+            return json.load(f).get("version") == RESULT_VERSION and output_path.exists()
+    except (OSError, ValueError):
+        return False
+
 
-def process_single_file(edf_file, output_dir, subjects_dir, save_as_hdf5=False):
+def process_single_file(edf_file, output_dir, subjects_dir, save_as_hdf5=False, cache_dir=None, beamformer=None):
     try:
         logger.info(f"Processing file: {edf_file.name}")
-        beamformer = Beamformer(subjects_dir)
-        raw = mne.io.read_raw_edf(edf_file, preload=True)
-        fwd = beamformer.create_forward_model(raw)
-        logger.info("Dynamically calculating regularization parameter...")
-        noise_cov = mne.compute_raw_covariance(raw, tmin=0, tmax=None)
-        print(noise_cov.data.mean())
-        reg = 1e-5 if noise_cov.data.mean() < 1e-4 else 0.05
-        stc = beamformer.apply_beamformer(raw, fwd, cov = noise_cov, reg=reg)
-        stc_atlas = beamformer.map_to_atlas(stc, fwd)
-        output_path = Path(output_dir) / f"{edf_file.stem}_stc_atlas"
-        metadata = {"subject": beamformer.subject, "atlas": beamformer.atlas_name}
-        save_results(stc_atlas, output_path, save_as_hdf5=save_as_hdf5, metadata=metadata)
+        beamformer = beamformer or Beamformer(subjects_dir, cache_dir=cache_dir)
+        # Not preloaded: covariance and ROI time courses read the file in blocks.
+        raw = mne.io.read_raw_edf(edf_file, preload=False)
+        fwd = beamformer.create_forward_model(raw, surf_ori=True)
+        logger.info("Estimating the data covariance with OAS shrinkage...")
+        data_cov, shrinkage = streaming_covariance(raw, method="oas")
+        # The shrinkage is the regularization; make_lcmv adds none on top.
+        roi = beamformer.make_roi_operator(raw, fwd, cov=data_cov, reg=0.0)
+        output_path = output_path_for(edf_file, output_dir, save_as_hdf5)
+        metadata = {"version": RESULT_VERSION, "subject": beamformer.subject, "atlas": beamformer.atlas_name,
+                    "pick_ori": roi["pick_ori"], "mode": roi["mode"], "covariance": "oas", "shrinkage": shrinkage,
+                    "sfreq": raw.info["sfreq"], "labels": roi["label_names"]}
+        shape = (len(roi["label_names"]), raw.n_times)
+        with array_writer(output_path, shape, metadata=metadata) as stc_atlas:
+            for start, stop, block in iter_roi_chunks(raw, roi):
+                stc_atlas[:, start:stop] = block
+        write_sidecar(output_path, metadata)
         logger.info(f"Results saved at {output_path}")
+        return output_path
     except Exception as e:
         logger.error(f"Error processing file {edf_file.name}: {e}", exc_info=True)
+        return None
 
-def process_files_from_csv(csv_file, output_dir, subjects_dir, use_parallel=False, n_jobs=4, save_as_hdf5=False):
+
+def init_worker(subjects_dir, cache_dir, n_jobs, template_file=None):
+    # Runs once per worker process: pins its thread budget, reads the atlas
+    # labels and loads the forward solution for the montage of
+    # `template_file`, so recordings sharing it reuse everything in memory.
+    global _worker_beamformer
+    configure_worker(n_jobs)
+    _worker_beamformer = Beamformer(subjects_dir, cache_dir=cache_dir)
+    try:
+        _worker_beamformer.labels()
+        if template_file is not None:
+            _worker_beamformer.create_forward_model(mne.io.read_raw_edf(template_file, preload=False), surf_ori=True)
+    except Exception as e:
+        # Left to the per-file processing, which reports the error per recording.
+        logger.warning(f"Could not preload labels and forward model: {e}")
+
+
+def process_in_worker(edf_file, output_dir, save_as_hdf5):
+    return process_single_file(
+        edf_file, output_dir, _worker_beamformer.subjects_dir, save_as_hdf5, beamformer=_worker_beamformer
+    )
+
+
+def log_progress(done, total, failed, start):
+    elapsed = time.monotonic() - start
+    rate = done / elapsed * 3600 if elapsed else 0.0
+    eta = (total - done) / rate if rate else 0.0
+    logger.info(f"[{done}/{total}] {failed} failed, {rate:.1f} recordings/hour, about {eta:.1f}h left")
+
+
+def process_files_from_csv(csv_file, output_dir, subjects_dir, use_parallel=False, n_jobs=None, save_as_hdf5=False,
+                           cache_dir=None, max_files=None, resume=True):
     try:
         os.makedirs(output_dir, exist_ok=True)
         with open(csv_file, mode="r", encoding="utf-8") as file:
             reader = csv.reader(file)
             next(reader)
-            edf_files = [Path(row[0]) for row in list(reader)[:10]]
+            edf_files = [Path(row[0]) for row in reader if row][:max_files]
+        if resume:
+            # Only results with a sidecar of the current version count as done;
+            # anything else is overwritten with a current result.
+            pending = [edf_file for edf_file in edf_files
+                       if not is_current_result(output_path_for(edf_file, output_dir, save_as_hdf5))]
+            if len(pending) < len(edf_files):
+                logger.info(f"Resuming: {len(edf_files) - len(pending)} of {len(edf_files)} recordings already done.")
+            edf_files = pending
+        if not edf_files:
+            logger.info("Nothing to process.")
+            return
+
+        succeeded, failed = 0, 0
+        start = time.monotonic()
         if use_parallel:
-            Parallel(n_jobs=n_jobs)(
-                delayed(process_single_file)(edf_file, output_dir, subjects_dir, save_as_hdf5)
-                for edf_file in edf_files
-            )
+            workers, inner_jobs = plan_parallelism("beamforming", len(edf_files), n_jobs)
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker,
+                initargs=(subjects_dir, cache_dir, inner_jobs, edf_files[0]),
+            ) as executor:
+                futures = [
+                    executor.submit(process_in_worker, edf_file, output_dir, save_as_hdf5) for edf_file in edf_files
+                ]
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        ok = future.result() is not None
+                    except Exception as e:
+                        logger.error(f"Worker failed: {e}")
+                        ok = False
+                    succeeded, failed = succeeded + ok, failed + (not ok)
+                    log_progress(succeeded + failed, len(edf_files), failed, start)
         else:
+            beamformer = Beamformer(subjects_dir, cache_dir=cache_dir)
             for edf_file in edf_files:
-                process_single_file(edf_file, output_dir, subjects_dir, save_as_hdf5)
-        logger.info("Processing completed.")
+                ok = process_single_file(edf_file, output_dir, subjects_dir, save_as_hdf5, beamformer=beamformer) is not None
+                succeeded, failed = succeeded + ok, failed + (not ok)
+                log_progress(succeeded + failed, len(edf_files), failed, start)
+
+        hours = (time.monotonic() - start) / 3600
+        logger.info(
+            f"Processing completed: {succeeded} succeeded, {failed} failed, "
+            f"{succeeded / hours if hours else 0:.1f} recordings/hour."
+        )
     except Exception as e:
         logger.error("Batch processing failed.", exc_info=True)
         raise
@@ -60,14 +171,22 @@ if __name__ == "__main__":
     parser.add_argument("--batch", action="store_true", help="Process all files in the batch folder.")
     parser.add_argument("--singlefile", action="store_true", help="Process a single .edf file.")
     parser.add_argument("--hdf5", action="store_true", help="Save results in HDF5 format.")
+    parser.add_argument("--parallel", action="store_true", help="Process the batch in parallel worker processes.")
+    parser.add_argument("--workers", type=int, default=None, help="Maximum number of worker processes.")
+    parser.add_argument("--max-files", type=int, default=None, help="Only process the first N recordings.")
+    parser.add_argument("--no-resume", action="store_true", help="Reprocess recordings that already have results.")
     args = parser.parse_args()
     CSV_FILE = "followup_recordings.csv"
     OUTPUT_DIR = "beamforming_results"
     SINGLE_FILE = "eeg_raw_ica_subset/sub-001_ses-1_task-EyesClosed_acq-post_eeg_fastica_processed.edf"
     SUBJECTS_DIR = "subjects_dir"
+    FORWARD_CACHE_DIR = "beamforming_cache"
     if args.singlefile:
-        process_single_file(Path(SINGLE_FILE), OUTPUT_DIR, SUBJECTS_DIR, save_as_hdf5=args.hdf5)
+        process_single_file(Path(SINGLE_FILE), OUTPUT_DIR, SUBJECTS_DIR, save_as_hdf5=args.hdf5,
+                            cache_dir=FORWARD_CACHE_DIR)
     elif args.batch:
-        process_files_from_csv(CSV_FILE, OUTPUT_DIR, SUBJECTS_DIR, save_as_hdf5=args.hdf5)
+        process_files_from_csv(CSV_FILE, OUTPUT_DIR, SUBJECTS_DIR, use_parallel=args.parallel, n_jobs=args.workers,
+                               save_as_hdf5=args.hdf5, cache_dir=FORWARD_CACHE_DIR, max_files=args.max_files,
+                               resume=not args.no_resume)
     else:
         logger.error("Specify either --batch or --singlefile.")
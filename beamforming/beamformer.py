@@ -1,47 +1,51 @@
+import hashlib
 import mne
 import numpy as np
 from pathlib import Path
+from beamforming.forward_cache import ForwardCache
+from beamforming.roi_projection import apply_roi_operator, label_operator, roi_operator
+from utils.concurrency import stage_n_jobs
 from utils.logger_manager import LoggerManager
 
 logger = LoggerManager.get_logger("Beamforming")
 
 class Beamformer:
-    def __init__(self, subjects_dir, atlas_name="aparc.a2009s", subject="fsaverage"):
+    def __init__(self, subjects_dir, atlas_name="aparc.a2009s", subject="fsaverage", cache_dir=None):
         self.subjects_dir = Path(subjects_dir)
         self.atlas_name = atlas_name
         self.subject = subject
+        self.forward_cache = ForwardCache(subjects_dir, cache_dir=cache_dir, n_jobs=stage_n_jobs())
+        self._labels = None
+        self._label_operators = {}
 
-    def create_forward_model(self, raw):
+    def labels(self):
+        if self._labels is None:
+            self._labels = mne.read_labels_from_annot(
+                self.subject,
+                parc=self.atlas_name,
+                subjects_dir=self.subjects_dir
+            )
+        return self._labels
+
+    def label_operator(self, vertices, src, mode="mean_flip"):
+        # The label averaging only depends on the source space, so it is
+        # computed once and reused for every recording.
+        key = (mode, hashlib.sha1(np.concatenate(vertices)).hexdigest())
+        if key not in self._label_operators:
+            self._label_operators[key] = label_operator(self.labels(), vertices, src=src, mode=mode)
+        return self._label_operators[key]
+
+    def create_forward_model(self, raw, surf_ori=False):
         try:
             logger.info("Creating forward model...")
             raw.set_montage("standard_1020")
 
-            # Set up the source space
-            logger.info("Setting up the source space with spacing='ico4' and computing distances.")
-            src = mne.setup_source_space(
-                subject=self.subject,
-                spacing="ico4",
-                surface="white",
-                subjects_dir=self.subjects_dir,
-                add_dist=True,
-                n_jobs=4
-            )
-
-            # Create BEM model and solution
-            logger.info("Creating BEM model and solution with ico=4.")
-            bem = mne.make_bem_model(subject=self.subject, ico=4, subjects_dir=self.subjects_dir)
-            bem_sol = mne.make_bem_solution(bem)
-
-            # Create forward model
-            logger.info("Creating the forward model...")
-            fwd = mne.make_forward_solution(
-                raw.info,
-                trans=None,
-                src=src,
-                bem=bem_sol,
-                eeg=True,
-                meg=False
-            )
+            # The source space (ico4, with distances), the ico=4 BEM solution
+            # and the forward solution for this channel set are built once
+            # and then loaded from the cache. surf_ori=True gives the cached
+            # surface-oriented copy that pick_ori="normal" filters need.
+            logger.info("Getting the forward model for spacing='ico4' and BEM ico=4.")
+            fwd = self.forward_cache.forward(raw.info, self.subject, spacing="ico4", ico=4, surf_ori=surf_ori)
 
             logger.info("Forward model created successfully.")
             return fwd
@@ -71,15 +75,48 @@ class Beamformer:
             logger.error("Error applying beamformer.", exc_info=True)
             raise
 
+    def make_roi_operator(self, raw, fwd, cov=None, reg=0.05, pick_ori="normal", mode="mean_flip"):
+        try:
+            logger.info("Setting average EEG reference...")
+            raw.set_eeg_reference(projection=True)
+
+            if pick_ori == "normal" and not fwd["surf_ori"]:
+                # Copies the forward for every call; create_forward_model(raw,
+                # surf_ori=True) returns a cached surface-oriented one instead.
+                logger.info("Converting the forward model to surface orientation...")
+                fwd = mne.convert_forward_solution(fwd, surf_ori=True)
+            logger.info(f"Computing LCMV filters with reg={reg}, pick_ori={pick_ori}...")
+            filters = mne.beamformer.make_lcmv(
+                raw.info,
+                fwd,
+                cov,
+                reg=reg,
+                pick_ori=pick_ori
+            )
+            # Label averaging folded into the filters: one row per label of
+            # the atlas, one column per channel.
+            averaging = self.label_operator(filters["vertices"], fwd["src"], mode=mode)
+            roi = roi_operator(filters, self.labels(), src=fwd["src"], mode=mode, averaging=averaging)
+            logger.info(f"ROI operator ready: {roi['operator'].shape[0]} labels x {roi['operator'].shape[1]} channels.")
+            return roi
+        except Exception as e:
+            logger.error("Error computing ROI operator.", exc_info=True)
+            raise
+
+    def apply_roi_beamformer(self, raw, fwd, cov=None, reg=0.05, pick_ori="normal", mode="mean_flip"):
+        # ROI time courses straight from the sensor data: the same result as
+        # apply_lcmv_raw with these filters (same fixed pick_ori) followed by
+        # extract_label_time_course with the same linear mode, but the vertex
+        # x time source estimate is never built. This is not what
+        # apply_beamformer + map_to_atlas computes, which use free
+        # orientations and mode="mean".
+        roi = self.make_roi_operator(raw, fwd, cov=cov, reg=reg, pick_ori=pick_ori, mode=mode)
+        return apply_roi_operator(raw, roi)
+
     def map_to_atlas(self, stc, fwd):
         try:
             logger.info(f"Mapping results to atlas: {self.atlas_name}")
-            labels = mne.read_labels_from_annot(
-                self.subject,
-                parc=self.atlas_name,
-                subjects_dir=self.subjects_dir
-            )
-            stc_atlas = stc.extract_label_time_course(labels, fwd["src"], mode="mean")
+            stc_atlas = stc.extract_label_time_course(self.labels(), fwd["src"], mode="mean")
             logger.info("Atlas mapping completed successfully.")
             return stc_atlas
         except Exception as e:
@@ -0,0 +1,134 @@
+import hashlib
+import os
+from collections import OrderedDict
+from pathlib import Path
+
+import mne
+import numpy as np
+
+from utils.logger_manager import LoggerManager
+
+logger = LoggerManager.get_logger("ForwardCache")
+
+# Forward solutions kept in memory per process; batch workers build or load
+# them once and reuse them for every recording with the same montage.
+MEMORY_ENTRIES = 8
+_memory = OrderedDict()
+
+
+def channel_set_hash(info):
+    # EEG channel names and positions, rounded to a micrometre so the same
+    # montage read from different files hashes the same.
+    picks = mne.pick_types(info, eeg=True, exclude=[])
+    digest = hashlib.sha256()
+    for pick in picks:
+        digest.update(info["ch_names"][pick].encode())
+        digest.update(np.round(info["chs"][pick]["loc"][:3], 6).tobytes())
+    return digest.hexdigest()
+
+
+def _remember(key, value):
+    _memory[key] = value
+    _memory.move_to_end(key)
+    while len(_memory) > MEMORY_ENTRIES:
+        _memory.popitem(last=False)
+    return value
+
+
+def _cached(key, path, build, read, write):
+    # Memory first, then disk, then build. Writes go to a partial file that is
+    # renamed into place, so concurrent workers never read a half-written one.
+    if key in _memory:
+        _memory.move_to_end(key)
+        return _memory[key]
+    if path is not None and path.exists():
+        try:
+            value = read(path)
+            logger.info(f"Loaded {path.name} from the forward cache")
+            return _remember(key, value)
+        except Exception as e:
+            logger.warning(f"Rebuilding, could not read {path}: {e}")
+    value = build()
+    if path is not None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        partial = path.with_name(f"partial_{os.getpid()}_{path.name}")
+        write(partial, value)
+        os.replace(partial, path)
+        logger.info(f"Saved {path.name} to the forward cache")
+    return _remember(key, value)
+
+
+class ForwardCache:
+    """Source spaces, BEM solutions and forward solutions on disk and in memory.
+
+    Source spaces are keyed by (subject, spacing), BEM solutions by
+    (subject, ico) and forward solutions additionally by the hash of the EEG
+    channel set, since that is all that differs between recordings with the
+    same montage. With `cache_dir=None` only the in-memory copies are kept.
+    Surface-oriented forward solutions are derived from the cached one and
+    kept in memory only.
+    Returned objects are shared and must be treated as read-only.
+    """
+
+    def __init__(self, subjects_dir, cache_dir=None, n_jobs=None):
+        self.subjects_dir = Path(subjects_dir)
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.n_jobs = n_jobs
+
+    def _path(self, name):
+        return self.cache_dir / name if self.cache_dir is not None else None
+
+    def source_space(self, subject, spacing="ico4"):
+        return _cached(
+            ("src", str(self.subjects_dir), subject, spacing),
+            self._path(f"{subject}-{spacing}-src.fif"),
+            lambda: mne.setup_source_space(
+                subject=subject,
+                spacing=spacing,
+                surface="white",
+                subjects_dir=self.subjects_dir,
+                add_dist=True,
+                n_jobs=self.n_jobs,
+            ),
+            lambda path: mne.read_source_spaces(path, verbose=False),
+            lambda path, src: mne.write_source_spaces(path, src, overwrite=True),
+        )
+
+    def bem_solution(self, subject, ico=4):
+        return _cached(
+            ("bem", str(self.subjects_dir), subject, ico),
+            self._path(f"{subject}-ico{ico}-bem-sol.fif"),
+            lambda: mne.make_bem_solution(
+                mne.make_bem_model(subject=subject, ico=ico, subjects_dir=self.subjects_dir)
+            ),
+            lambda path: mne.read_bem_solution(path, verbose=False),
+            lambda path, bem: mne.write_bem_solution(path, bem, overwrite=True),
+        )
+
+    def forward(self, info, subject, spacing="ico4", ico=4, surf_ori=False):
+        channels = channel_set_hash(info)
+        if surf_ori:
+            return _cached(
+                ("fwd_surf_ori", str(self.subjects_dir), subject, spacing, ico, channels),
+                None,
+                lambda: mne.convert_forward_solution(
+                    self.forward(info, subject, spacing, ico), surf_ori=True, copy=True
+                ),
+                None,
+                None,
+            )
+        return _cached(
+            ("fwd", str(self.subjects_dir), subject, spacing, ico, channels),
+            self._path(f"{subject}-{spacing}-bem{ico}-{channels[:16]}-fwd.fif"),
+            lambda: mne.make_forward_solution(
+                info,
+                trans=None,
+                src=self.source_space(subject, spacing),
+                bem=self.bem_solution(subject, ico),
+                eeg=True,
+                meg=False,
+                n_jobs=self.n_jobs,
+            ),
+            lambda path: mne.read_forward_solution(path, verbose=False),
+            lambda path, fwd: mne.write_forward_solution(path, fwd, overwrite=True),
+        )
@@ -0,0 +1,88 @@
+import mne
+import numpy as np
+from scipy import sparse
+
+from utils.logger_manager import LoggerManager
+
+logger = LoggerManager.get_logger("ROIProjection")
+
+LINEAR_MODES = ("mean", "mean_flip")
+# Samples per block when streaming sensor data through an operator.
+CHUNK_SECONDS = 60
+
+
+def label_operator(labels, vertices, src=None, mode="mean_flip"):
+    """Sparse (n_labels, n_sources) averaging matrix over the filter's sources.
+
+    Row i averages the sources of labels[i], ordered like `vertices` (left
+    hemisphere followed by right). With mode="mean_flip" the sources are sign
+    flipped first, the same way mne's extract_label_time_course does, so
+    sources with opposite normals do not cancel.
+    """
+    if mode not in LINEAR_MODES:
+        raise ValueError(f"mode must be one of {LINEAR_MODES}, got {mode!r}")
+    if mode == "mean_flip" and src is None:
+        raise ValueError("mode='mean_flip' needs the source space")
+    offsets = np.cumsum([0] + [len(vertno) for vertno in vertices])
+    rows, cols, weights = [], [], []
+    for row, label in enumerate(labels):
+        hemi = 1 if label.hemi == "rh" and len(vertices) > 1 else 0
+        selected = np.intersect1d(vertices[hemi], label.vertices)
+        if selected.size == 0:
+            logger.warning(f"Label {label.name} has no sources in the source space")
+            continue
+        flip = mne.label_sign_flip(label, src) if mode == "mean_flip" else np.ones(selected.size)
+        rows.append(np.full(selected.size, row))
+        cols.append(offsets[hemi] + np.searchsorted(vertices[hemi], selected))
+        weights.append(flip / selected.size)
+    shape = (len(labels), offsets[-1])
+    if not rows:
+        return sparse.csr_matrix(shape)
+    return sparse.csr_matrix(
+        (np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))), shape=shape
+    )
+
+
+def roi_operator(filters, labels, src=None, mode="mean_flip", averaging=None):
+    """Fold label averaging into LCMV filters: an (n_labels, n_channels) matrix.
+
+    The label operator times the spatial filters times the projector/whitener
+    mne would apply to the sensor data, so `operator @ data` gives the same
+    ROI time courses as apply_lcmv_raw followed by label extraction, without
+    the vertex x time source estimate. Filters must have a fixed orientation
+    per source (pick_ori "normal" or "max-power"), since combining free
+    orientations is not linear. `averaging` is a label_operator computed
+    earlier for the same sources, labels and mode.
+    """
+    if filters["is_free_ori"]:
+        raise ValueError("ROI operators need filters with pick_ori='normal' or 'max-power'")
+    if averaging is None:
+        averaging = label_operator(labels, filters["vertices"], src=src, mode=mode)
+    weights = averaging @ filters["weights"]
+    if filters["whitener"] is not None:
+        weights = weights @ filters["whitener"]
+    elif filters.get("is_ssp", True):
+        weights = weights @ filters["proj"]
+    return {
+        "operator": np.ascontiguousarray(weights),
+        "ch_names": list(filters["ch_names"]),
+        "label_names": [label.name for label in labels],
+        "mode": mode,
+        "pick_ori": filters["pick_ori"],
+    }
+
+
+def apply_roi_operator(raw, roi, start=0, stop=None):
+    # Samples are read without applying projections, as apply_lcmv_raw does;
+    # the average reference projector is already part of the operator.
+    picks = [raw.ch_names.index(name) for name in roi["ch_names"]]
+    return roi["operator"] @ raw.get_data(picks=picks, start=start, stop=stop)
+
+
+def iter_roi_chunks(raw, roi, chunk_seconds=CHUNK_SECONDS):
+    # ROI time courses in consecutive time blocks, so neither the sensor data
+    # of an unloaded Raw nor the output has to be in memory at once.
+    chunk = max(1, int(chunk_seconds * raw.info["sfreq"]))
+    for start in range(0, raw.n_times, chunk):
+        stop = min(start + chunk, raw.n_times)
+        yield start, stop, apply_roi_operator(raw, roi, start=start, stop=stop)
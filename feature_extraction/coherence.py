@@ -3,7 +3,8 @@ import numpy as np
 import pandas as pd
 from scipy.signal import coherence
 from joblib import Parallel, delayed
-from mne.io import read_raw_edf
+from utils.concurrency import stage_n_jobs
+from utils.recording_store import is_recording_file, read_recording
 
 
 BANDS = {
@@ -20,11 +21,11 @@ def compute_coherence_for_pair(data1, data2, sfreq, band, nperseg=1024):
     freq_band = (f >= fmin) & (f < fmax)
     return np.mean(Cxy[freq_band])
 
-def compute_coherence_matrix(data, sfreq, band, n_jobs=-1, nperseg=1024):
+def compute_coherence_matrix(data, sfreq, band, n_jobs=None, nperseg=1024):
     n_channels = data.shape[0]
     pairs = [(i, j) for i in range(n_channels) for j in range(i + 1, n_channels)]
 
-    coherence_values = Parallel(n_jobs=n_jobs)(
+    coherence_values = Parallel(n_jobs=stage_n_jobs(n_jobs))(
         delayed(compute_coherence_for_pair)(data[i], data[j], sfreq, band, nperseg)
         for i, j in pairs
     )
@@ -36,10 +37,10 @@ def compute_coherence_matrix(data, sfreq, band, n_jobs=-1, nperseg=1024):
 
     return coherence_matrix, pairs
 
-def process_file(filepath, band, n_jobs=-1, nperseg=1024):
+def process_file(filepath, band, n_jobs=None, nperseg=1024):
     print(f"Processing file: {filepath}")
 
-    raw = read_raw_edf(filepath, preload=True)
+    raw = read_recording(filepath)
     data = raw.get_data()
     sfreq = raw.info['sfreq']
 
@@ -67,13 +68,13 @@ def main():
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
 
     band = BANDS["alpha"]
-    n_jobs = -1
+    n_jobs = None
     nperseg = 1024
 
     all_results = []
 
     for file in sorted(os.listdir(input_dir)):
-        if file.endswith(".edf"):
+        if is_recording_file(file):
             filepath = os.path.join(input_dir, file)
             results = process_file(filepath, band, n_jobs=n_jobs, nperseg=nperseg)
             all_results.extend(results)
@@ -3,6 +3,7 @@ import pandas as pd
 from scipy.stats import entropy, kurtosis, skew
 from mne.time_frequency import tfr_array_morlet, psd_array_welch
 from mne.filter import filter_data
+from utils.concurrency import stage_n_jobs
 
 
 
@@ -61,7 +62,7 @@ def extract_statistical_features(raw, entropy_bins=100, spike_threshold_multipli
         })
     return features
 
-def extract_psd_features(raw, fmin=1, fmax=99, n_fft=1024, n_overlap=512, n_per_seg=None, n_jobs=-1):
+def extract_psd_features(raw, fmin=1, fmax=99, n_fft=1024, n_overlap=512, n_per_seg=None, n_jobs=None):
     features = []
     data = raw.get_data()
     sfreq = raw.info.get("sfreq", 250)
@@ -73,7 +74,7 @@ def extract_psd_features(raw, fmin=1, fmax=99, n_fft=1024, n_overlap=512, n_per_
         n_fft=n_fft,
         n_overlap=n_overlap,
         n_per_seg=n_per_seg,
-        n_jobs=n_jobs,
+        n_jobs=stage_n_jobs(n_jobs),
         average="mean",
     )
     total_power = psds.sum(axis=1)
@@ -110,7 +111,7 @@ def extract_plv_features(raw):
                 })
     return features
 
-def extract_tfr_features(raw, freqs, n_cycles, use_fft=True, decim=1, n_jobs=-1, output="power"):
+def extract_tfr_features(raw, freqs, n_cycles, use_fft=True, decim=1, n_jobs=None, output="power"):
     features = []
     data = raw.get_data()[np.newaxis, :, :]
     sfreq = raw.info.get("sfreq", 250)
@@ -122,7 +123,7 @@ def extract_tfr_features(raw, freqs, n_cycles, use_fft=True, decim=1, n_jobs=-1,
         use_fft=use_fft,
         decim=decim,
         output=output,
-        n_jobs=n_jobs,
+        n_jobs=stage_n_jobs(n_jobs),
     )
     tfr_data = tfr_data_all[0]
     time_avg_tfr = tfr_data.mean(axis=-1)
@@ -0,0 +1,214 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import mne
+import numpy as np
+import pandas as pd
+
+from feature_extraction.feature_extractor import (
+    extract_temporal_frequency_features,
+    extract_statistical_features,
+    extract_psd_features,
+    extract_tfr_features,
+    compute_band_and_relative_power,
+    compute_channel_basic_features,
+)
+from utils.concurrency import stage_cores
+from utils.logger_manager import LoggerManager
+
+logger = LoggerManager.get_logger("FeatureJobs")
+
+DEFAULT_FEATURE_PARAMS = {
+    "n_channels": 64,
+    "tfr_freqs": (4, 8, 13, 30, 50),
+    "tfr_n_cycles": 7,
+}
+
+# One small stage only: every quick look delays the full extraction running
+# after it in the same job.
+QUICK_LOOK_FRACTION = 0.05
+QUICK_LOOK_WINDOW_SECONDS = 2.0
+# Counts over the sampled windows, rescaled to the length of the recording.
+COUNT_FEATURES = ("SpikeCount",)
+# Extremes of the signal: a subset only ever underestimates them, and the
+# split-half error cannot show it, so the quick look leaves them out.
+EXTREME_FEATURES = ("EventRelatedDynamics", "PeakToPeak", "PeakToPeakAmplitude")
+
+
+def feature_params_key(params):
+    return tuple(sorted(
+        (name, tuple(value) if isinstance(value, (list, tuple)) else value)
+        for name, value in params.items()
+    ))
+
+
+def extract_combined_features(raw, params=None, progress=None, n_jobs=None):
+    params = {**DEFAULT_FEATURE_PARAMS, **(params or {})}
+    progress = progress or (lambda fraction, message: None)
+
+    steps = [
+        ("Temporal/frequency features", extract_temporal_frequency_features, {}),
+        ("Statistical features", extract_statistical_features, {}),
+        ("Welch PSD features", extract_psd_features, {"n_jobs": n_jobs}),
+        ("Morlet TFR features", extract_tfr_features, {
+            "freqs": np.array(params["tfr_freqs"]),
+            "n_cycles": params["tfr_n_cycles"],
+            "n_jobs": n_jobs,
+        }),
+        ("Band and relative power", compute_band_and_relative_power, {}),
+        ("Channel basic features", compute_channel_basic_features, {}),
+    ]
+    frames = []
+    for index, (label, extractor, kwargs) in enumerate(steps):
+        progress(index / len(steps), f"{label}...")
+        frames.append(pd.DataFrame(extractor(raw, **kwargs)))
+    progress(1.0, "Feature extraction complete.")
+
+    combined_features = pd.concat(frames, axis=1)
+    combined_features = combined_features.loc[:, ~combined_features.columns.duplicated()]
+    return combined_features.select_dtypes(include=["number"])
+
+
+def split_half_windows(raw, data, fraction, rng, window_seconds=QUICK_LOOK_WINDOW_SECONDS):
+    # Draw random non-overlapping windows covering `fraction` of the recording
+    # and deal them alternately into two halves of equal size.
+    window = int(window_seconds * raw.info["sfreq"])
+    n_windows = data.shape[1] // window
+    n_selected = int(round(n_windows * fraction))
+    n_selected -= n_selected % 2
+    if n_selected < 2:
+        return None
+    starts = np.sort(rng.choice(n_windows, size=n_selected, replace=False)) * window
+    halves = []
+    for half_starts in (starts[0::2], starts[1::2]):
+        half = np.concatenate([data[:, start:start + window] for start in half_starts], axis=1)
+        halves.append(mne.io.RawArray(half, raw.info, verbose=False))
+    return halves
+
+
+def rescale_counts(features, scale):
+    counts = [name for name in COUNT_FEATURES if name in features.columns]
+    features[counts] = features[counts] * scale
+    return features
+
+
+def estimate_features_from_windows(raw, data, fraction, params, rng, n_jobs=None):
+    halves = split_half_windows(raw, data, fraction, rng)
+    if halves is None:
+        return None
+    first, second = (
+        rescale_counts(extract_combined_features(half, params, n_jobs=n_jobs), data.shape[1] / half.n_times)
+        for half in halves
+    )
+    not_estimated = [name for name in EXTREME_FEATURES if name in first.columns]
+    first, second = first.drop(columns=not_estimated), second.drop(columns=not_estimated)
+    estimate = (first + second) / 2
+    # Half the split-half difference, relative to the magnitude of the estimate.
+    magnitude = (first.abs() + second.abs()).replace(0, np.nan)
+    relative_error = (first - second).abs() / magnitude
+    cell_errors = relative_error.to_numpy().ravel()
+    cell_errors = cell_errors[~np.isnan(cell_errors)]
+    return {
+        "fraction": fraction,
+        "features": estimate,
+        "not_estimated": not_estimated,
+        "relative_error": relative_error,
+        "median_relative_error": float(np.median(cell_errors)) if cell_errors.size else 0.0,
+        "p90_relative_error": float(np.quantile(cell_errors, 0.9)) if cell_errors.size else 0.0,
+    }
+
+
+class FeatureJob:
+    def __init__(self, key):
+        self.key = key
+        self.progress = 0.0
+        self.message = "Queued"
+        self.result = None
+        self.error = None
+        self.started_at = time.time()
+        self.finished_at = None
+        self.future = None
+        self.stages = []
+
+    @property
+    def preview(self):
+        return self.stages[-1] if self.stages else None
+
+    @property
+    def done(self):
+        return self.result is not None or self.error is not None
+
+    def update(self, fraction, message):
+        self.progress = fraction
+        self.message = message
+
+
+class FeatureJobManager:
+    # Runs feature extraction in background threads and keeps finished results
+    # keyed by (recording hash, parameters), so reruns and other sessions that
+    # ask for the same recording never touch the Raw object again.
+    def __init__(self, max_workers=2, max_results=64):
+        self.max_results = max_results
+        # Each job thread gets an equal share of the feature stage's cores, so
+        # concurrent jobs do not each start an all-core mne/joblib pool.
+        self.n_jobs = max(1, stage_cores("features") // max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="features")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, recording_hash, params=None):
+        key = (recording_hash, feature_params_key({**DEFAULT_FEATURE_PARAMS, **(params or {})}))
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None:
+                self._jobs.move_to_end(key)
+            return job
+
+    def submit(self, recording_hash, raw, params=None, quick_look=False):
+        params = {**DEFAULT_FEATURE_PARAMS, **(params or {})}
+        key = (recording_hash, feature_params_key(params))
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job.error is None:
+                return job
+            job = FeatureJob(key)
+            self._jobs[key] = job
+            self._evict()
+        job.future = self._executor.submit(self._run, job, raw, params, quick_look)
+        return job
+
+    def _run(self, job, raw, params, quick_look):
+        try:
+            job.update(0.0, "Preparing recording...")
+            raw = raw.copy().pick(raw.info["ch_names"][:params["n_channels"]])
+            if quick_look:
+                self._run_quick_look(job, raw, params)
+            result = extract_combined_features(raw, params, progress=job.update, n_jobs=self.n_jobs)
+            job.finished_at = time.time()
+            job.result = result
+            logger.info(f"Features extracted for recording {job.key[0][:12]} in {job.finished_at - job.started_at:.1f}s")
+        except Exception as e:
+            logger.error(f"Feature extraction failed for recording {job.key[0][:12]}: {e}", exc_info=True)
+            job.finished_at = time.time()
+            job.error = e
+
+    def _run_quick_look(self, job, raw, params):
+        data = raw.get_data()
+        rng = np.random.default_rng(0)
+        job.update(0.0, f"Quick look on {QUICK_LOOK_FRACTION:.0%} of the recording...")
+        stage = estimate_features_from_windows(raw, data, QUICK_LOOK_FRACTION, params, rng, n_jobs=self.n_jobs)
+        if stage is None:
+            return
+        stage["elapsed"] = time.time() - job.started_at
+        job.stages.append(stage)
+        logger.info(
+            f"Quick look ({QUICK_LOOK_FRACTION:.0%}) for recording {job.key[0][:12]}: "
+            f"median relative error {stage['median_relative_error']:.2%}"
+        )
+
+    def _evict(self):
+        finished = [key for key, job in self._jobs.items() if job.done]
+        while len(self._jobs) > self.max_results and finished:
+            self._jobs.pop(finished.pop(0))
@@ -2,7 +2,8 @@ import os
 import numpy as np
 import pandas as pd
 from utils.results_saver import save_to_csv
-from mne.io import read_raw_edf
+from utils.concurrency import stage_n_jobs
+from utils.recording_store import is_recording_file, read_recording
 from mne.time_frequency import tfr_array_morlet
 
 BANDS = {
@@ -41,7 +42,7 @@ def extract_tfr_features(tfr_data, freqs, raw, filename):
             })
     return pd.DataFrame(features)
 
-def compute_tfr_morlet(raw, freqs, n_cycles, use_fft=True, decim=1, n_jobs=-1, output="power"):
+def compute_tfr_morlet(raw, freqs, n_cycles, use_fft=True, decim=1, n_jobs=None, output="power"):
 
     data = raw.get_data()[np.newaxis, :, :]
     sfreq = raw.info.get("sfreq", 250)
@@ -53,7 +54,7 @@ def compute_tfr_morlet(raw, freqs, n_cycles, use_fft=True, decim=1, n_jobs=-1, o
         use_fft=use_fft,
         decim=decim,
         output=output,
-        n_jobs=n_jobs,
+        n_jobs=stage_n_jobs(n_jobs),
     )
 
     return tfr_data[0], freqs
@@ -63,7 +64,7 @@ def process_file(file, input_dir, output_file):
     filepath = os.path.join(input_dir, file)
     print(f"Processing file: {file}")
 
-    raw = read_raw_edf(filepath, preload=True)
+    raw = read_recording(filepath)
     if raw is None:
         print(f"Skipping file {file} due to loading error.")
         return
@@ -83,7 +84,7 @@ def main():
     output_file = "./feature_extraction/results/tfr_features_morlet.csv"
 
     for file in sorted(os.listdir(input_dir)):  # Ensure files are processed in order
-        if file.endswith(".edf"):
+        if is_recording_file(file):
             process_file(file, input_dir, output_file)
 
 if __name__ == "__main__":
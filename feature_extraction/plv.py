@@ -2,7 +2,7 @@ import os
 import numpy as np
 import pandas as pd
 from mne.filter import filter_data
-from mne.io import read_raw_edf
+from utils.recording_store import is_recording_file, read_recording
 
 BANDS = {
     "delta": (1, 4),
@@ -33,7 +33,7 @@ def compute_plv_matrix(data, sfreq, band):
 def process_file(filepath, band):
     print(f"Processing file: {filepath}")
 
-    raw = read_raw_edf(filepath, preload=True)
+    raw = read_recording(filepath)
     data = raw.get_data()
     sfreq = raw.info['sfreq']
 
@@ -64,7 +64,7 @@ def main():
     all_results = []
 
     for file in sorted(os.listdir(input_dir)):
-        if file.endswith(".edf"):
+        if is_recording_file(file):
             filepath = os.path.join(input_dir, file)
             results = process_file(filepath, band)
             all_results.extend(results)
@@ -1,8 +1,9 @@
 import os
 import numpy as np
 import pandas as pd
-from mne.io import read_raw_edf
+from utils.recording_store import is_recording_file, read_recording
 from utils.results_saver import save_to_csv
+from utils.concurrency import stage_n_jobs
 from mne.time_frequency import psd_array_welch
 
 BANDS = {
@@ -18,7 +19,7 @@ def compute_total_power(psds):
     total_power = psds.sum(axis=1)
     return total_power
 
-def compute_psd_welch(raw, fmin=1, fmax=99, n_fft=1024, n_overlap=512, n_per_seg=None, n_jobs=-1):
+def compute_psd_welch(raw, fmin=1, fmax=99, n_fft=1024, n_overlap=512, n_per_seg=None, n_jobs=None):
     data = raw.get_data()
     sfreq = raw.info.get("sfreq", 250)
     psds, freqs = psd_array_welch(
@@ -29,7 +30,7 @@ def compute_psd_welch(raw, fmin=1, fmax=99, n_fft=1024, n_overlap=512, n_per_seg
         n_fft=n_fft,
         n_overlap=n_overlap,
         n_per_seg=n_per_seg,
-        n_jobs=n_jobs,
+        n_jobs=stage_n_jobs(n_jobs),
         average="mean",
     )
     return psds, freqs
@@ -54,7 +55,7 @@ def process_file(file, input_dir, output_file):
     filepath = os.path.join(input_dir, file)
     print(f"Processing file: {file}")
 
-    raw = read_raw_edf(filepath, preload=True)
+    raw = read_recording(filepath)
     if raw is None:
         print(f"Skipping file {file} due to loading error.")
         return
@@ -72,7 +73,7 @@ def main():
     output_file = "./feature_extraction/results/psd_features_welch.csv"
 
     for file in sorted(os.listdir(input_dir)):  # Ensure files are processed in order
-        if file.endswith(".edf"):
+        if is_recording_file(file):
             process_file(file, input_dir, output_file)
 
 if __name__ == "__main__":
@@ -1,16 +1,17 @@
 import os
 import pandas as pd
-from mne.io import read_raw_edf
+from utils.concurrency import stage_n_jobs
+from utils.recording_store import StoredRecording, is_recording_file, read_recording
 from utils.results_saver import save_to_csv
 from mne.time_frequency import Spectrum
 
-def compute_spectrum(raw, fmin=1, fmax=99, method="welch", n_jobs=-1):
+def compute_spectrum(raw, fmin=1, fmax=99, method="welch", n_jobs=None):
 
     spectrum_data = raw.compute_psd(
         fmin=fmin,
         fmax=fmax,
         method=method,
-        n_jobs=n_jobs
+        n_jobs=stage_n_jobs(n_jobs)
     )
     return spectrum_data
 
@@ -24,10 +25,13 @@ def process_file(file, input_dir, output_file):
     filepath = os.path.join(input_dir, file)
     print(f"Processing file: {file}")
 
-    raw = read_raw_edf(filepath, preload=True)
+    raw = read_recording(filepath)
     if raw is None:
         print(f"Skipping file {file} due to loading error.")
         return
+    if isinstance(raw, StoredRecording):
+        # compute_psd needs a full mne Raw.
+        raw = raw.to_raw()
 
     spectrum_data = compute_spectrum(raw)
 
@@ -43,7 +47,7 @@ def main():
 
 
     for file in sorted(os.listdir(input_dir)):
-        if file.endswith(".edf"):
+        if is_recording_file(file):
             process_file(file, input_dir, output_file)
 
 if __name__ == "__main__":
@@ -0,0 +1,86 @@
+import os
+from pathlib import Path
+
+import mne
+import numpy as np
+from scipy.signal import resample_poly
+
+from preprocessing.resampling import design_antialias
+from utils.logger_manager import LoggerManager
+
+logger = LoggerManager.get_logger("ICAFitting")
+
+# Parameters only used when applying a fitted ICA (which components to
+# remove, where to save it). They do not change the unmixing matrix, so they
+# are left out of the key a saved decomposition is reused under.
+APPLY_ONLY_PARAMS = ("exclude", "ica_path")
+
+
+def segment_reject_threshold(data, sfreq, tstep=2.0, factor=5.0):
+    # Peak-to-peak threshold for mne's segment rejection: `factor` times the
+    # median of the worst channel in each `tstep` window, so only the gross
+    # artifacts that dominate ICA components are dropped.
+    window = max(1, int(tstep * sfreq))
+    n_windows = data.shape[1] // window
+    if n_windows == 0:
+        return None
+    segments = data[:, :n_windows * window].reshape(data.shape[0], n_windows, window)
+    worst = np.ptp(segments, axis=2).max(axis=0)
+    return float(np.median(worst) * factor)
+
+
+def make_fit_subset(raw, fit_sfreq=100.0, l_freq=1.0):
+    # Decimated copy of the recording, high-passed at l_freq if it is not
+    # already: ICA only needs the spatial statistics, and slow drifts would
+    # otherwise dominate the fit. The polyphase decimation applies its
+    # anti-alias filter only at the kept samples, so the new lowpass holds.
+    decim = max(1, int(raw.info["sfreq"] // fit_sfreq))
+    picks = mne.pick_types(raw.info, eeg=True, exclude=[])
+    data = raw.get_data(picks=picks)
+    if decim > 1:
+        data = resample_poly(data, 1, decim, axis=1, window=np.array(design_antialias(1, decim)), padtype="reflect")
+    info = mne.pick_info(raw.info, picks)
+    with info._unlock():
+        info["sfreq"] = raw.info["sfreq"] / decim
+        info["lowpass"] = min(info["lowpass"], info["sfreq"] / 2)
+    subset = mne.io.RawArray(data, info, verbose=False)
+    subset.set_annotations(raw.annotations)
+    if l_freq is not None and raw.info["highpass"] < l_freq:
+        subset.filter(l_freq=l_freq, h_freq=None, fir_design="firwin", verbose=False)
+    return subset, decim
+
+
+def fit_ica_on_subset(ica, raw, fit_sfreq=100.0, l_freq=1.0, reject_factor=5.0):
+    subset, decim = make_fit_subset(raw, fit_sfreq=fit_sfreq, l_freq=l_freq)
+    reject = None
+    if reject_factor:
+        threshold = segment_reject_threshold(subset.get_data(), subset.info["sfreq"], factor=reject_factor)
+        reject = {"eeg": threshold} if threshold else None
+    ica.fit(subset, reject=reject, reject_by_annotation=True, verbose=False)
+    logger.info(
+        f"ICA fitted on a subset decimated by {decim} "
+        f"({subset.n_times} of {raw.n_times} samples, reject={reject})"
+    )
+    return ica
+
+
+def load_ica(ica_path):
+    if ica_path is None or not Path(ica_path).exists():
+        return None
+    try:
+        ica = mne.preprocessing.read_ica(ica_path, verbose=False)
+        logger.info(f"Loaded fitted ICA from {ica_path}")
+        return ica
+    except Exception as e:
+        logger.warning(f"Refitting ICA, could not read {ica_path}: {e}")
+        return None
+
+
+def save_ica(ica, ica_path):
+    ica_path = Path(ica_path)
+    ica_path.parent.mkdir(parents=True, exist_ok=True)
+    partial = ica_path.with_name(f"partial_{os.getpid()}_{ica_path.name}")
+    ica.save(partial, overwrite=True, verbose=False)
+    os.replace(partial, ica_path)
+    logger.info(f"Saved fitted ICA to {ica_path}")
+    return str(ica_path)
@@ -1,62 +1,233 @@
 import concurrent.futures
+import contextlib
+import json
+import multiprocessing
+import signal
+import time
 from pathlib import Path
-from preprocessing import preprocess_file
+from preprocessing.preprocessing import preprocess_file
+from preprocessing.scheduler import (
+    MEMORY_BUDGET_FRACTION,
+    JobScheduler,
+    available_memory_bytes,
+    plan_jobs,
+)
+from utils.concurrency import configure_worker, plan_parallelism
 from utils.logger_manager import LoggerManager
 
 logger = LoggerManager.get_logger("ParallelPipeline")
 
 
-def process_single_file(file, output_dir, preprocessing_steps):
+TASKS_PER_WORKER = 20
+FILE_TIMEOUT = 1800
+HARD_TIMEOUT_GRACE = 120
+MAX_ATTEMPTS = 3
+RETRY_BACKOFF = 30
+QUARANTINE_FILE = "quarantine.jsonl"
+
+
+class FileTimeoutError(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def time_limit(seconds):
+    # Raises FileTimeoutError inside the worker once `seconds` have passed.
+    # This interrupts Python-level loops such as an ICA fit; a call stuck in
+    # native code is handled by the parent killing the worker instead.
+    if not seconds or not hasattr(signal, "SIGALRM"):
+        yield
+        return
+
+    def handler(signum, frame):
+        raise FileTimeoutError(f"Processing exceeded {seconds}s")
+
+    previous = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
     try:
-        logger.info(f"Starting pipeline for {file}")
-        results = preprocess_file(file, output_dir, preprocessing_steps)
-        if results.get("error"):
-            logger.error(f"Processing failed for {file}: {results['error']}")
-        else:
-            intermediate_file = results.get("intermediate_file")
-            ica_files = results.get("ica_files", [])
-            logger.info(f"Intermediate file saved: {intermediate_file}")
-            logger.info(f"ICA files generated: {ica_files}")
-        logger.info(f"Pipeline completed for {file}")
-    except Exception as e:
-        logger.error(f"Error processing file {file}: {e}", exc_info=True)
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def process_single_file(file, output_dir, preprocessing_steps, cache_dir=None, timeout=None, output_format="edf"):
+    logger.info(f"Starting pipeline for {file}")
+    with time_limit(timeout):
+        results = preprocess_file(
+            file, output_dir, preprocessing_steps, cache_dir=cache_dir, output_format=output_format
+        )
+    if results.get("error"):
+        raise RuntimeError(results["error"])
+    logger.info(f"ICA files generated: {results.get('ica_files')}")
+    logger.info(f"Pipeline completed for {file}")
+    return results
+
+
+def load_quarantine(output_dir):
+    path = Path(output_dir) / QUARANTINE_FILE
+    if not path.exists():
+        return set()
+    with open(path) as f:
+        return {json.loads(line)["file"] for line in f if line.strip()}
+
+
+def quarantine_file(output_dir, job):
+    path = Path(output_dir) / QUARANTINE_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a") as f:
+        f.write(json.dumps({"file": str(job.path), "attempts": job.attempts, "errors": job.errors}) + "\n")
+    logger.error(f"Quarantined {job.path} after {job.attempts} failed attempts: {job.errors[-1]}")
 
 
-def run_parallel_pipeline(input_dir, output_dir, preprocessing_steps, max_files=4, max_workers=None):
+def make_executor(max_workers, tasks_per_worker, n_jobs=1):
+    # Fresh interpreters that are replaced after `tasks_per_worker` files, so
+    # memory leaked by a worker is returned to the system regularly.
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        max_tasks_per_child=tasks_per_worker,
+        initializer=configure_worker,
+        initargs=(n_jobs,),
+    )
+
+
+def kill_executor(executor):
+    for process in list(getattr(executor, "_processes", {}).values()):
+        process.kill()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def run_parallel_pipeline(input_dir, output_dir, preprocessing_steps, max_files=4, max_workers=None, cache_dir=None,
+                          memory_budget=None, timeout=FILE_TIMEOUT, max_attempts=MAX_ATTEMPTS,
+                          tasks_per_worker=TASKS_PER_WORKER, retry_quarantined=False, output_format="edf"):
     file_list = list(Path(input_dir).glob("*.edf"))[:max_files]
     if not file_list:
         logger.error(f"No files found in {input_dir}")
         return
 
+    quarantined = set() if retry_quarantined else load_quarantine(output_dir)
+    skipped = [file for file in file_list if str(file) in quarantined]
+    file_list = [file for file in file_list if str(file) not in quarantined]
+    if skipped:
+        logger.warning(f"Skipping {len(skipped)} quarantined files listed in {Path(output_dir) / QUARANTINE_FILE}")
+    if not file_list:
+        return
+
+    max_workers, n_jobs = plan_parallelism("preprocessing", len(file_list), max_workers)
+    memory_budget = memory_budget or int(available_memory_bytes() * MEMORY_BUDGET_FRACTION)
+    jobs = plan_jobs(file_list)
     logger.info(f"Found {len(file_list)} files to process.")
-    logger.info(f"Using up to {max_workers if max_workers else 'auto-detected'} workers for parallel processing.")
+    logger.info(
+        f"Using up to {max_workers} workers within a {memory_budget / 1024 ** 3:.1f} GiB memory budget; "
+        f"largest job needs an estimated {jobs[0].memory_bytes / 1024 ** 3:.2f} GiB."
+    )
+
+    scheduler = JobScheduler(jobs, memory_budget, max_workers)
+    executor = make_executor(max_workers, tasks_per_worker, n_jobs)
+    succeeded, failed = 0, 0
+    start = time.monotonic()
+
+    def record_failure(job, error):
+        nonlocal failed
+        job.attempts += 1
+        job.errors.append(str(error))
+        if job.attempts >= max_attempts:
+            failed += 1
+            quarantine_file(output_dir, job)
+        else:
+            delay = RETRY_BACKOFF * 2 ** (job.attempts - 1)
+            logger.warning(f"Attempt {job.attempts} for {job.path} failed ({error}); retrying in {delay}s")
+            scheduler.requeue(job, delay)
+
+    try:
+        while scheduler:
+            for job in scheduler.ready():
+                future = executor.submit(
+                    process_single_file, job.path, output_dir, preprocessing_steps, cache_dir, timeout, output_format
+                )
+                scheduler.start(job, future)
+
+            wait_for = scheduler.next_wakeup()
+            poll = 5.0 if wait_for is None else min(5.0, wait_for)
+            done, _ = concurrent.futures.wait(
+                list(scheduler.running), timeout=poll, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            broken = False
+            crashed = []
+            for future in done:
+                job = scheduler.finish(future)
+                try:
+                    future.result()
+                    succeeded += 1
+                    logger.info(f"Successfully processed file: {job.path}")
+                except concurrent.futures.process.BrokenProcessPool:
+                    # A worker died (e.g. killed for memory); every file in
+                    # flight fails with it, whichever one caused it.
+                    broken = True
+                    crashed.append(job)
+                except Exception as e:
+                    record_failure(job, e)
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(process_single_file, file, output_dir, preprocessing_steps): file for file in file_list}
+            if timeout:
+                now = time.monotonic()
+                hung = [
+                    future for future, job in scheduler.running.items()
+                    if now - job.started_at > timeout + HARD_TIMEOUT_GRACE
+                ]
+                if hung:
+                    # The worker did not honour its own time limit, so it is
+                    # stuck in native code: replace the whole pool.
+                    broken = True
+                    for future in hung:
+                        record_failure(scheduler.finish(future), f"hard timeout after {timeout + HARD_TIMEOUT_GRACE}s")
 
-        for future in concurrent.futures.as_completed(futures):
-            file = futures[future]
-            try:
-                future.result()
-                logger.info(f"Successfully processed file: {file}")
-            except Exception as e:
-                logger.error(f"Error processing file {file}: {e}")
+            if broken:
+                in_flight = [scheduler.finish(future) for future in list(scheduler.running)]
+                if crashed:
+                    # Only a file that ran alone is charged an attempt for a
+                    # dead worker; the others are retried one at a time so
+                    # the one at fault is found without quarantining the rest.
+                    suspects = crashed + in_flight
+                    for job in suspects:
+                        if job.isolate or len(suspects) == 1:
+                            record_failure(job, "worker died")
+                        else:
+                            job.isolate = True
+                            scheduler.requeue(job)
+                else:
+                    for job in in_flight:
+                        scheduler.requeue(job)
+                kill_executor(executor)
+                executor = make_executor(max_workers, tasks_per_worker, n_jobs)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
 
-    logger.info("Parallel pipeline run completed.")
+    hours = (time.monotonic() - start) / 3600
+    logger.info(
+        f"Parallel pipeline run completed: {succeeded} succeeded, {failed} quarantined, "
+        f"{succeeded / hours if hours else 0:.0f} files/hour."
+    )
 
 
 if __name__ == "__main__":
     input_dir = "eeg_raw"
     output_dir = "eeg_raw_ica"
     preprocessing_steps = [
-        {"method": "downsample", "params": {"target_sfreq": 250}},
-        {"method": "apply_notch_filter", "params": {"freqs": (50, 100)}},
-        {"method": "apply_bandpass_filter", "params": {"l_freq": 1, "h_freq": 99}},
-        {"method": "apply_ica", "params": {"method": "fastica", "n_components": 40}},
+        {"method": "downsample", "params": {"target_sfreq": 250, "method": "polyphase"}},
+        {"method": "apply_filter_bank", "params": {"freqs": (50, 100), "l_freq": 1, "h_freq": 99}},
+        {"method": "apply_ica", "params": {"method": "fastica", "n_components": 40, "fit": "subset"}},
 #       {"method": "apply_ica", "params": {"method": "picard", "n_components": 20}},
 #       {"method": "apply_ica", "params": {"method": "infomax", "n_components": 20}}
     ]
     max_files = 3265
     max_workers = 6
+    cache_dir = "eeg_step_cache"
+    # "fif" or "store" write faster, but the beamforming and DB feature
+    # scripts that consume this directory only read EDF.
+    output_format = "edf"
 
-    run_parallel_pipeline(input_dir, output_dir, preprocessing_steps, max_files=max_files, max_workers=max_workers)
+    run_parallel_pipeline(
+        input_dir, output_dir, preprocessing_steps, max_files=max_files, max_workers=max_workers, cache_dir=cache_dir,
+        output_format=output_format,
+    )
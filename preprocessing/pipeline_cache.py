@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+import mne
+from utils.logger_manager import LoggerManager
+
+logger = LoggerManager.get_logger("PipelineCache")
+
+EXPORT_FORMATS = {
+    "edf": "preprocessed_file.edf",
+    "fif": "preprocessed_file_raw.fif",
+}
+
+# Disk budget of the step artifact cache, shared by every process using it.
+STEP_CACHE_MAX_BYTES = 20 * 1024 ** 3
+# Disk budget of the exported downloads.
+EXPORT_MAX_BYTES = 5 * 1024 ** 3
+
+_export_locks = {}
+_export_locks_guard = threading.Lock()
+
+
+def evict_lru(directory, pattern, max_bytes, keep=None):
+    # Deletes the least recently used (by mtime) files matching `pattern` in
+    # `directory` until together they fit in max_bytes. Partial writes and
+    # `keep` are never deleted.
+    entries = []
+    for path in Path(directory).glob(pattern):
+        if path.name.startswith("partial_"):
+            continue
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        path.unlink(missing_ok=True)
+        total -= size
+        logger.info(f"Evicted {path.name} from {directory}")
+
+
+def processing_graph_hash(input_hash, preprocessing_steps):
+    # Identifies a processed recording by its input and the full step list, so
+    # two runs with the same graph share every derived artifact.
+    graph = {
+        "input": input_hash,
+        "steps": [
+            {"method": step.get("method"), "params": step.get("params", {})}
+            for step in preprocessing_steps
+        ],
+    }
+    encoded = json.dumps(graph, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def step_keys(input_hash, preprocessing_steps):
+    # One key per prefix of the step list: the artifact after step i depends on
+    # the input and on the parameters of every step up to and including i.
+    return [
+        processing_graph_hash(input_hash, preprocessing_steps[:index + 1])
+        for index in range(len(preprocessing_steps))
+    ]
+
+
+class StepArtifactCache:
+    # Intermediate recordings on disk, one FIF per step-list prefix. Data is
+    # stored as float64 so a cached prefix gives exactly the same downstream
+    # results as recomputing it. Files are evicted least-recently-used (by
+    # mtime, refreshed on every hit) once together they exceed max_bytes.
+    def __init__(self, cache_dir, max_bytes=STEP_CACHE_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return self.cache_dir / f"{key[:32]}_raw.fif"
+
+    def load(self, key):
+        path = self.path(key)
+        if not path.exists():
+            return None
+        try:
+            raw = mne.io.read_raw_fif(path, preload=True, verbose=False)
+            os.utime(path)
+            return raw
+        except Exception as e:
+            logger.warning(f"Discarding unreadable step artifact {path}: {e}")
+            path.unlink(missing_ok=True)
+            return None
+
+    def store(self, key, raw):
+        path = self.path(key)
+        if path.exists():
+            return path
+        partial = path.with_name(f"partial_{os.getpid()}_{path.name}")
+        try:
+            raw.save(str(partial), fmt="double", overwrite=True, verbose=False)
+            os.replace(partial, path)
+        finally:
+            if partial.exists():
+                partial.unlink()
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        evict_lru(self.cache_dir, "*_raw.fif", self.max_bytes, keep=keep)
+
+    def longest_prefix(self, keys):
+        # Returns (number of steps already done, recording after them).
+        for done in range(len(keys), 0, -1):
+            raw = self.load(keys[done - 1])
+            if raw is not None:
+                return done, raw
+        return 0, None
+
+
+def export_path(export_dir, graph_hash, fmt):
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    return Path(export_dir) / f"{graph_hash[:32]}_{EXPORT_FORMATS[fmt]}"
+
+
+def cached_export(raw, graph_hash, fmt, export_dir="./temp/exports", max_bytes=EXPORT_MAX_BYTES):
+    # Exports once per (graph, format); later requests reuse the file on disk.
+    # Exports are evicted least-recently-used once they exceed max_bytes.
+    path = export_path(export_dir, graph_hash, fmt)
+    if path.exists():
+        os.utime(path)
+        return path
+
+    with _export_locks_guard:
+        lock = _export_locks.setdefault(str(path), threading.Lock())
+    with lock:
+        if path.exists():
+            return path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write under a temporary name so a half-written file is never served.
+        partial = path.with_name(f"partial_{os.getpid()}_{path.name}")
+        try:
+            if fmt == "edf":
+                raw.export(str(partial), fmt="EDF", overwrite=True)
+            else:
+                raw.save(str(partial), overwrite=True)
+            os.replace(partial, path)
+        finally:
+            if partial.exists():
+                partial.unlink()
+        logger.info(f"Exported {fmt.upper()} for graph {graph_hash[:12]} to {path}")
+    evict_lru(export_dir, "*_preprocessed_file*", max_bytes, keep=path)
+    return path
@@ -1,13 +1,30 @@
+import threading
+import time
+import tracemalloc
 import mne
 from pathlib import Path
+from preprocessing import filter_bank, ica_fitting
+from preprocessing.resampling import resample_polyphase
+from preprocessing.pipeline_cache import StepArtifactCache, processing_graph_hash, step_keys
 from utils.logger_manager import LoggerManager
-from utils.visualization import plot_raw, plot_psd
-import matplotlib
+from utils.recording_cache import hash_file
+from utils.recording_store import save_store, store_path
 
 
 logger = LoggerManager.get_logger("Preprocessing")
 
 PREPROCESSING_METHODS = {}
+# Figure builders for steps with visual side outputs. Registered methods never
+# draw anything themselves, so batch workers stay headless; the UI asks for
+# figures explicitly through step_figures().
+STEP_FIGURES = {}
+FILTER_METHODS = ("apply_notch_filter", "apply_bandpass_filter", "apply_filter_bank")
+# Steps that produce an output branch instead of feeding later steps, so a
+# list can sweep several ICA settings over the same filtered data.
+BRANCH_METHODS = ("apply_ica",)
+PREVIEW_SECONDS = 10.0
+# tracemalloc is process-wide: one traced step at a time across UI sessions.
+_TRACE_LOCK = threading.Lock()
 
 def register_preprocessing_method(name):
     def decorator(func):
@@ -15,10 +32,29 @@ def register_preprocessing_method(name):
         return func
     return decorator
 
-def save_file(raw, output_dir, base_name, suffix):
+def register_step_figures(name):
+    def decorator(func):
+        STEP_FIGURES[name] = func
+        return func
+    return decorator
+
+def step_figures(method_name, side_output, raw_before):
+    if method_name not in STEP_FIGURES or side_output is None:
+        return []
+    return STEP_FIGURES[method_name](side_output, raw_before)
+
+def save_file(raw, output_dir, base_name, suffix, output_format="edf"):
+    # "fif" keeps float32 samples and all of mne's metadata; "store" writes a
+    # memory-mappable float32 array that feature extraction reads zero-copy.
     try:
-        file_path = Path(output_dir) / f"{base_name}_{suffix}.edf"
-        raw.export(file_path, fmt="EDF", overwrite=True)
+        if output_format == "store":
+            file_path = save_store(raw, store_path(output_dir, base_name, suffix))
+        elif output_format == "fif":
+            file_path = Path(output_dir) / f"{base_name}_{suffix}_raw.fif"
+            raw.save(file_path, overwrite=True)
+        else:
+            file_path = Path(output_dir) / f"{base_name}_{suffix}.edf"
+            raw.export(file_path, fmt="EDF", overwrite=True)
         logger.info(f"File saved: {file_path}")
         return str(file_path)
     except Exception as e:
@@ -36,9 +72,16 @@ def save_plot(fig, output_dir, base_name, suffix):
         return None
 
 @register_preprocessing_method("downsample")
-def downsample(raw, target_sfreq=250):
-    raw.resample(sfreq=target_sfreq)
-    logger.info(f"Downsampled to {target_sfreq} Hz.")
+def downsample(raw, target_sfreq=250, method="fft", l_freq=None, h_freq=None):
+    # method="polyphase" uses a rational resampler with a cached anti-alias
+    # filter; l_freq/h_freq fold a following band-pass into the same step.
+    if method == "polyphase":
+        raw = resample_polyphase(raw, target_sfreq, l_freq=l_freq, h_freq=h_freq)
+    else:
+        raw.resample(sfreq=target_sfreq)
+        if l_freq is not None or h_freq is not None:
+            raw.filter(l_freq=l_freq, h_freq=h_freq, fir_design="firwin")
+    logger.info(f"Downsampled to {target_sfreq} Hz ({method}).")
     return raw
 
 @register_preprocessing_method("apply_notch_filter")
@@ -53,44 +96,169 @@ def apply_bandpass_filter(raw, l_freq=1, h_freq=99):
     logger.info(f"Band-pass filter applied (l_freq={l_freq}, h_freq={h_freq}).")
     return raw
 
+@register_preprocessing_method("apply_filter_bank")
+def apply_filter_bank(raw, freqs=(50, 100), l_freq=1, h_freq=99):
+    filter_bank.apply_filter_bank(raw, freqs=freqs, l_freq=l_freq, h_freq=h_freq)
+    logger.info(f"Fused notch ({freqs}) and band-pass ({l_freq}-{h_freq} Hz) filter applied.")
+    return raw
+
 @register_preprocessing_method("apply_ica")
-def apply_ica(raw, method="fastica", n_components=40, random_state=42, max_iter="auto", montage="standard_1020"):
+def apply_ica(raw, method="fastica", n_components=40, random_state=42, max_iter="auto", montage="standard_1020",
+              fit="full", fit_sfreq=100.0, fit_l_freq=1.0, reject_factor=5.0, ica_path=None, exclude=None):
+    # fit="subset" fits on a decimated, high-passed, artifact-rejected copy of
+    # the recording. With ica_path the fitted ICA is saved there, and reused on
+    # later runs so that changing `exclude` never triggers a refit.
     raw.set_montage(montage)
     logger.info(f"Montage set to {montage} for ICA.")
 
-    ica = mne.preprocessing.ICA(
-        n_components=n_components,
-        method=method,
-        random_state=random_state,
-        max_iter=max_iter
+    ica = ica_fitting.load_ica(ica_path)
+    if ica is None:
+        ica = mne.preprocessing.ICA(
+            n_components=n_components,
+            method=method,
+            random_state=random_state,
+            max_iter=max_iter
+        )
+        if fit == "subset":
+            ica_fitting.fit_ica_on_subset(ica, raw, fit_sfreq=fit_sfreq, l_freq=fit_l_freq,
+                                          reject_factor=reject_factor)
+        else:
+            ica.fit(raw)
+        logger.info(f"ICA applied using {method}.")
+        if ica_path is not None:
+            ica_fitting.save_ica(ica, ica_path)
+    ica.apply(raw, exclude=list(exclude) if exclude is not None else None)
+
+    return raw, ica
+
+@register_step_figures("apply_ica")
+def ica_figures(ica, raw_before):
+    return [ica.plot_components(show=False), ica.plot_overlay(raw_before, show=False)]
+
+def take_checkpoint(raw, method_name):
+    # A small stand-in for the recording at one point of the pipeline, so the
+    # before/after views never need a second full copy of the data: a PSD
+    # summary around filters and a short raw preview around everything else.
+    if method_name in FILTER_METHODS:
+        fmax = min(99, raw.info["sfreq"] / 2)
+        return raw.compute_psd(fmin=0.5, fmax=fmax, picks="eeg", verbose=False)
+    stop = min(raw.n_times, int(PREVIEW_SECONDS * raw.info["sfreq"]))
+    return mne.io.RawArray(raw.get_data(stop=stop), raw.info.copy(), verbose=False)
+
+def run_step(raw, method_name, params, trace_memory=False):
+    # Applies one registered step in place. With trace_memory (the UI only),
+    # it also reports the peak memory allocated on top of what was already
+    # live; tracemalloc is process-wide and slows every allocation, so traced
+    # steps are serialized and batch runs leave it off.
+    start = time.perf_counter()
+    peak_bytes = None
+    if trace_memory:
+        with _TRACE_LOCK:
+            was_tracing = tracemalloc.is_tracing()
+            if not was_tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            try:
+                baseline, _ = tracemalloc.get_traced_memory()
+                result = PREPROCESSING_METHODS[method_name](raw, **params)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                if not was_tracing:
+                    tracemalloc.stop()
+        peak_bytes = max(0, peak - baseline)
+    else:
+        result = PREPROCESSING_METHODS[method_name](raw, **params)
+    stats = {
+        "method": method_name,
+        "seconds": time.perf_counter() - start,
+        "peak_bytes": peak_bytes,
+        "data_bytes": raw._data.nbytes,
+    }
+    peak = f", peak {peak_bytes / 1024 ** 2:.1f} MiB" if peak_bytes is not None else ""
+    logger.info(
+        f"{method_name}: {stats['seconds']:.1f}s{peak} over a {stats['data_bytes'] / 1024 ** 2:.1f} MiB recording"
     )
-    ica.fit(raw)
-    logger.info(f"ICA applied using {method}.")
-    fig = ica.plot_components(show=False)
-    fig2 = ica.plot_overlay(raw, show=False)
-    ica.apply(raw)
+    return result, stats
 
-    return raw , fig, fig2
+def materialize(trunk, load_input, input_hash=None, cache=None, raw=None, done=0):
+    # Brings a recording up to the end of `trunk`, resuming from `raw` (with
+    # `done` steps applied) or from the longest prefix already in the cache.
+    # Only the end of the trunk is stored: that is what branches start from,
+    # and any longer trunk sharing it resumes from there.
+    keys = step_keys(input_hash, trunk) if cache is not None else []
+    if cache is not None and done < len(trunk):
+        cached_done, cached_raw = cache.longest_prefix(keys[done:])
+        if cached_raw is not None:
+            raw, done = cached_raw, done + cached_done
+            logger.info(f"Reusing cached result of the first {done} steps")
+    if raw is None:
+        raw = load_input()
+    computed = done < len(trunk)
+    for index in range(done, len(trunk)):
+        step = trunk[index]
+        raw, _ = run_step(raw, step["method"], step.get("params", {}))
+    if cache is not None and computed:
+        cache.store(keys[-1], raw)
+    return raw
 
-def preprocess_file(input_file, output_dir, preprocessing_steps):
+def preprocess_file(input_file, output_dir, preprocessing_steps, cache_dir=None, output_format="edf"):
     try:
         logger.info(f"Processing file: {input_file}")
-        raw = mne.io.read_raw_edf(input_file, preload=True)
         base_name = Path(input_file).stem
+        cache = StepArtifactCache(cache_dir) if cache_dir else None
+        load_input = lambda: mne.io.read_raw_edf(input_file, preload=True)
+
+        known_steps = []
         for step in preprocessing_steps:
-            method_name = step.get("method")
-            params = step.get("params", {})
-            if method_name in PREPROCESSING_METHODS:
-                if method_name == "apply_ica":
-                    raw_ica = raw.copy()
-                    raw_ica = PREPROCESSING_METHODS[method_name](raw_ica, **params)
-                    algo = params.get("method", "ica")
-                    ica_file = save_file(raw_ica, output_dir, base_name, f"{algo}_processed")
-                else:
-                    raw = PREPROCESSING_METHODS[method_name](raw, **params)
+            if step.get("method") in PREPROCESSING_METHODS:
+                known_steps.append(step)
             else:
-                logger.error(f"Unknown preprocessing method: {method_name}")
-        return {"ica_files": ica_file}
+                logger.error(f"Unknown preprocessing method: {step.get('method')}")
+        last_branch = max(
+            (index for index, step in enumerate(known_steps) if step["method"] in BRANCH_METHODS),
+            default=-1,
+        )
+        # Step artifacts and saved ICA fits are keyed by content, so a file
+        # edited in place at the same path never reuses stale results.
+        input_hash = hash_file(input_file) if cache is not None or last_branch >= 0 else None
+
+        branch_algos = [
+            step.get("params", {}).get("method", "ica") for step in known_steps if step["method"] in BRANCH_METHODS
+        ]
+
+        trunk, raw, done = [], None, 0
+        ica_files = []
+        for index, step in enumerate(known_steps):
+            if step["method"] not in BRANCH_METHODS:
+                trunk.append(step)
+                continue
+            raw = materialize(trunk, load_input, input_hash, cache, raw, done)
+            done = len(trunk)
+            # Only the last branch may consume the trunk in place.
+            branch_raw = raw if index == last_branch else raw.copy()
+            params = dict(step.get("params", {}))
+            algo = params.get("method", "ica")
+            if params.get("ica_path") is None:
+                # Keyed by the trunk and the fit parameters only, so a run that
+                # changes just the exclusions reuses the saved decomposition.
+                fit_params = {k: v for k, v in params.items() if k not in ica_fitting.APPLY_ONLY_PARAMS}
+                fit_key = processing_graph_hash(
+                    input_hash,
+                    trunk + [{"method": step["method"], "params": fit_params}],
+                )
+                ica_dir = Path(cache_dir) / "ica" if cache_dir else Path(output_dir)
+                params["ica_path"] = str(ica_dir / f"{base_name}_{algo}_{fit_key[:12]}-ica.fif")
+            (raw_ica, _), _ = run_step(branch_raw, step["method"], params)
+            suffix = f"{algo}_processed"
+            if branch_algos.count(algo) > 1:
+                # A sweep over one algorithm: name each output after its trunk
+                # and parameters so the branches do not overwrite each other.
+                branch_key = processing_graph_hash(input_hash, trunk + [step])
+                suffix = f"{algo}_{branch_key[:8]}_processed"
+            ica_files.append(save_file(raw_ica, output_dir, base_name, suffix, output_format))
+        if last_branch < 0 and trunk:
+            materialize(trunk, load_input, input_hash, cache, raw, done)
+        return {"ica_files": ica_files}
 
     except Exception as e:
         logger.error(f"Error processing file {input_file}: {e}", exc_info=True)
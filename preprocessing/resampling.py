@@ -0,0 +1,102 @@
+import time
+from fractions import Fraction
+from functools import lru_cache
+
+import mne
+import numpy as np
+from scipy.signal import firwin, resample_poly
+
+from preprocessing.filter_bank import apply_kernel, design_filter_bank
+from utils.logger_manager import LoggerManager
+
+logger = LoggerManager.get_logger("Resampling")
+
+
+def rational_factors(sfreq, target_sfreq, max_denominator=1000):
+    # Up/down factors from the two rates rather than from the signal length,
+    # so recordings with awkward sample counts keep small factors.
+    ratio = Fraction(target_sfreq).limit_denominator(max_denominator) / Fraction(sfreq).limit_denominator(max_denominator)
+    return ratio.numerator, ratio.denominator
+
+
+@lru_cache(maxsize=32)
+def design_antialias(up, down):
+    # The Kaiser low-pass resample_poly would design on every call.
+    max_rate = max(up, down)
+    kernel = firwin(2 * 10 * max_rate + 1, 1.0 / max_rate, window=("kaiser", 5.0))
+    kernel.setflags(write=False)
+    return kernel
+
+
+def _resample(raw, target_sfreq, up, down):
+    data = resample_poly(
+        raw._data, up, down, axis=1, window=np.array(design_antialias(up, down)), padtype="reflect"
+    )
+    final_len = int(round(raw.n_times * up / down))
+    data = data[:, :final_len]
+
+    info = raw.info.copy()
+    with info._unlock():
+        info["sfreq"] = float(target_sfreq)
+        info["lowpass"] = min(info["lowpass"], target_sfreq / 2)
+    resampled = mne.io.RawArray(
+        data, info, first_samp=int(round(raw.first_samp * up / down)), verbose=False
+    )
+    resampled.set_annotations(raw.annotations)
+    return resampled
+
+
+def resample_polyphase(raw, target_sfreq, l_freq=None, h_freq=None):
+    up, down = rational_factors(raw.info["sfreq"], target_sfreq)
+    if up == down:
+        # Already at the target rate: like raw.resample, leave the samples
+        # alone (there is no anti-alias filter for a 1/1 ratio).
+        resampled = raw
+    else:
+        resampled = _resample(raw, target_sfreq, up, down)
+
+    if l_freq is not None or h_freq is not None:
+        # A following band-pass runs in the same step as one cached FFT kernel
+        # at the reduced rate, where it costs a fraction of the full-rate pass.
+        kernel = design_filter_bank(float(target_sfreq), (), l_freq, h_freq)
+        apply_kernel(resampled._data, kernel, mne.pick_types(resampled.info, eeg=True, exclude=[]))
+        with resampled.info._unlock():
+            if l_freq is not None:
+                resampled.info["highpass"] = max(resampled.info["highpass"], float(l_freq))
+            if h_freq is not None:
+                resampled.info["lowpass"] = min(resampled.info["lowpass"], float(h_freq))
+    return resampled
+
+
+if __name__ == "__main__":
+    sfreq, target_sfreq, n_channels = 500.0, 250.0, 64
+    # A prime number of samples is the worst case for the FFT path.
+    n_times = 300007
+    rng = np.random.default_rng(0)
+    info = mne.create_info(n_channels, sfreq, "eeg")
+    raw = mne.io.RawArray(rng.standard_normal((n_channels, n_times)) * 1e-5, info, verbose=False)
+
+    same_rate = resample_polyphase(raw.copy(), sfreq)
+    assert same_rate.info["sfreq"] == sfreq and np.array_equal(same_rate.get_data(), raw.get_data())
+
+    start = time.perf_counter()
+    fft = raw.copy().resample(target_sfreq, verbose=False)
+    fft_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    poly = resample_polyphase(raw, target_sfreq)
+    poly_seconds = time.perf_counter() - start
+    logger.info(f"Downsample {n_times} samples: FFT {fft_seconds:.2f}s, polyphase {poly_seconds:.2f}s")
+
+    start = time.perf_counter()
+    fft.filter(l_freq=1, h_freq=99, fir_design="firwin", verbose=False)
+    two_step_seconds = fft_seconds + time.perf_counter() - start
+    start = time.perf_counter()
+    fused = resample_polyphase(raw, target_sfreq, l_freq=1, h_freq=99)
+    fused_seconds = time.perf_counter() - start
+    logger.info(f"Downsample + band-pass: FFT then filter {two_step_seconds:.2f}s, fused polyphase {fused_seconds:.2f}s")
+
+    reference = fft.get_data()
+    edge = int(target_sfreq * 5)
+    error = np.abs(fused.get_data() - reference)[:, edge:-edge]
+    scale = np.sqrt(np.mean(reference ** 2))
+    logger.info(f"Fused vs FFT then filter: max {error.max() / scale:.2e}, RMS {np.sqrt(np.mean(error ** 2)) / scale:.2e} (relative)")
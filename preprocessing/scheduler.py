@@ -0,0 +1,142 @@
+import os
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import mne
+
+from utils.logger_manager import LoggerManager
+
+logger = LoggerManager.get_logger("Scheduler")
+
+# Peak resident memory of one preprocessing job relative to its float64 data:
+# the loaded recording, the resampled copy and the filter/ICA work buffers.
+MEMORY_FACTOR = 3.0
+MEMORY_BUDGET_FRACTION = 0.8
+
+
+@dataclass
+class FileJob:
+    path: Path
+    n_channels: int
+    n_times: int
+    sfreq: float
+    memory_bytes: int
+    attempts: int = 0
+    not_before: float = 0.0
+    started_at: float = None
+    errors: list = field(default_factory=list)
+    # Suspected of killing its worker: runs with nothing else in the pool.
+    isolate: bool = False
+
+    @property
+    def cost(self):
+        # Every step is linear in the number of samples across channels.
+        return self.n_channels * self.n_times
+
+
+def read_header(path):
+    reader = mne.io.read_raw_fif if str(path).endswith(".fif") else mne.io.read_raw_edf
+    raw = reader(path, preload=False, verbose=False)
+    return len(raw.ch_names), raw.n_times, raw.info["sfreq"]
+
+
+def estimate_job(path, memory_factor=MEMORY_FACTOR):
+    try:
+        n_channels, n_times, sfreq = read_header(path)
+    except Exception as e:
+        # Unreadable headers still get scheduled, sized from the file, so the
+        # failure is reported by the worker like any other.
+        logger.warning(f"Could not read header of {path}: {e}")
+        size = os.path.getsize(path)
+        return FileJob(Path(path), 1, size // 2, 0.0, int(size * 4 * memory_factor))
+    memory_bytes = int(n_channels * n_times * 8 * memory_factor)
+    return FileJob(Path(path), n_channels, n_times, sfreq, memory_bytes)
+
+
+def available_memory_bytes():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def plan_jobs(files, memory_factor=MEMORY_FACTOR):
+    # Longest jobs first, so the big recordings do not end up as a tail that
+    # runs alone after everything else has finished.
+    jobs = [estimate_job(path, memory_factor) for path in files]
+    return sorted(jobs, key=lambda job: job.cost, reverse=True)
+
+
+class JobScheduler:
+    """Hands out jobs while their estimated memory fits the budget.
+
+    Jobs keep the order they were given in (longest first). Smaller jobs may
+    backfill behind one that does not fit yet, but only if the two would fit
+    together once the running jobs finish, so the large job is not starved.
+    A job larger than the whole budget runs alone, and so does a job marked
+    `isolate`; nothing else starts while it runs. Requeued jobs wait until
+    their `not_before` time.
+    """
+
+    def __init__(self, jobs, memory_budget, max_running):
+        self.pending = list(jobs)
+        self.running = {}
+        self.memory_budget = memory_budget
+        self.max_running = max_running
+        self.used = 0
+
+    def __bool__(self):
+        return bool(self.pending or self.running)
+
+    def ready(self, now=None):
+        now = time.monotonic() if now is None else now
+        if any(job.isolate for job in self.running.values()):
+            return []
+        eligible = [job for job in self.pending if job.not_before <= now]
+        started = []
+        for index, job in enumerate(eligible):
+            if len(self.running) + len(started) >= self.max_running:
+                break
+            if job.isolate:
+                # Waits for the pool to drain rather than being overtaken.
+                if not (self.running or started):
+                    started.append(job)
+                break
+            head = eligible[0]
+            in_use = self.used + sum(other.memory_bytes for other in started)
+            fits = in_use + job.memory_bytes <= self.memory_budget or not (self.running or started)
+            leaves_room = job is head or head in started or job.memory_bytes + head.memory_bytes <= self.memory_budget
+            if fits and leaves_room:
+                started.append(job)
+        for job in started:
+            self.pending.remove(job)
+        return started
+
+    def start(self, job, handle):
+        job.started_at = time.monotonic()
+        self.running[handle] = job
+        self.used += job.memory_bytes
+
+    def finish(self, handle):
+        job = self.running.pop(handle)
+        self.used -= job.memory_bytes
+        return job
+
+    def requeue(self, job, delay=0.0):
+        job.started_at = None
+        job.not_before = time.monotonic() + delay
+        position = next((i for i, other in enumerate(self.pending) if other.cost < job.cost), len(self.pending))
+        self.pending.insert(position, job)
+
+    def next_wakeup(self):
+        # Seconds until the next requeued job becomes eligible. Jobs that are
+        # already eligible but waiting for memory do not count: they can only
+        # start once a running job finishes.
+        now = time.monotonic()
+        waiting = [job.not_before for job in self.pending if job.not_before > now]
+        return min(waiting) - now if waiting else None
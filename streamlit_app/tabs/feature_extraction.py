@@ -1,71 +1,81 @@
-import numpy as np
+import time
 import streamlit as st
 import pandas as pd
-import mne
 
-from feature_extraction.feature_extractor import (
-    extract_temporal_frequency_features,
-    extract_statistical_features,
-    extract_psd_features,
-    extract_tfr_features,
-    compute_band_and_relative_power,
-    compute_channel_basic_features,
-)
+from feature_extraction.feature_jobs import FeatureJobManager, DEFAULT_FEATURE_PARAMS
 
-def render():
-    st.title("Feature Extraction")
+POLL_INTERVAL = 0.5
 
-    pd.options.display.float_format = '{:.12g}'.format
 
-    if "raw_initial" in st.session_state and st.session_state.raw_initial:
-        raw = st.session_state.raw_initial
+@st.cache_resource
+def get_feature_job_manager():
+    return FeatureJobManager()
 
-        raw.pick(raw.info["ch_names"][:64])
 
-        montage = mne.channels.make_standard_montage("standard_1020")
-        raw.set_montage(montage)
+def show_features(numeric_features):
+    st.session_state.features = numeric_features
 
-        st.info("Using uploaded or preloaded EEG file with 10-20 montage applied.")
+    st.subheader("Extracted Features")
+    st.dataframe(numeric_features)
 
-        st.info("Extracting features from EEG data. This may take a few moments...")
+    csv = numeric_features.to_csv(index=False)
+    st.download_button(
+        label="Download Features as CSV",
+        data=csv,
+        file_name="extracted_features.csv",
+        mime="text/csv",
+    )
 
-        temporal_freq_features = pd.DataFrame(extract_temporal_frequency_features(raw))
-        statistical_features = pd.DataFrame(extract_statistical_features(raw))
-        psd_features = pd.DataFrame(extract_psd_features(raw))
-        tfr_features = pd.DataFrame(
-            extract_tfr_features(raw, freqs=np.array([4, 8, 13, 30, 50]), n_cycles=7)
-        )
-        band_relative_power_features = pd.DataFrame(compute_band_and_relative_power(raw))
-        channel_basic_features = pd.DataFrame(compute_channel_basic_features(raw))
-
-        combined_features = pd.concat(
-            [
-                temporal_freq_features,
-                statistical_features,
-                psd_features,
-                tfr_features,
-                band_relative_power_features,
-                channel_basic_features,
-            ],
-            axis=1,
-        )
 
-        combined_features = combined_features.loc[:, ~combined_features.columns.duplicated()]
+def show_preview(stage):
+    st.subheader("Quick-Look Features (full extraction running)")
+    st.caption(
+        f"Estimated from {stage['fraction']:.0%} of the recording after {stage['elapsed']:.1f}s. "
+        f"Split-half relative error: median {stage['median_relative_error']:.1%}, "
+        f"90th percentile {stage['p90_relative_error']:.1%}."
+    )
+    if stage["not_estimated"]:
+        st.caption(f"Not estimated from a subset: {', '.join(stage['not_estimated'])}.")
+    st.dataframe(stage["features"])
 
-        numeric_features = combined_features.select_dtypes(include=["number"])
 
-        st.session_state.features = numeric_features
+def render():
+    st.title("Feature Extraction")
 
-        st.subheader("Extracted Features")
-        st.dataframe(numeric_features)
+    pd.options.display.float_format = '{:.12g}'.format
 
-        csv = numeric_features.to_csv(index=False)
-        st.download_button(
-            label="Download Features as CSV",
-            data=csv,
-            file_name="extracted_features.csv",
-            mime="text/csv",
+    if "raw_initial" in st.session_state and st.session_state.raw_initial:
+        recording_hash = st.session_state.get("recording_hash") or st.session_state.get("current_file_name")
+        params = dict(DEFAULT_FEATURE_PARAMS)
+        manager = get_feature_job_manager()
+        quick_look = st.checkbox(
+            "Quick-look preview", value=True,
+            help="Show features estimated from a random subset of the recording while the full extraction runs."
         )
 
+        job = manager.get(recording_hash, params)
+        if job is None or job.error is not None:
+            if job is not None:
+                st.error(f"Previous feature extraction failed: {job.error}")
+                if not st.button("Retry Feature Extraction"):
+                    return
+            st.info("Using uploaded or preloaded EEG file with 10-20 montage applied.")
+            job = manager.submit(recording_hash, st.session_state.raw_initial, params, quick_look=quick_look)
+
+        if not job.done:
+            st.info("Extracting features from EEG data in the background. You can switch tabs meanwhile.")
+            st.progress(job.progress, job.message)
+            if quick_look and job.preview is not None:
+                show_preview(job.preview)
+            time.sleep(POLL_INTERVAL)
+            st.rerun()
+
+        if job.error is not None:
+            st.error(f"Feature extraction failed: {job.error}")
+            return
+
+        st.caption(f"Features for this recording computed in {job.finished_at - job.started_at:.1f}s (cached).")
+        show_features(job.result)
+
     else:
         st.warning("No EEG file loaded. Please upload or select a file in the Upload tab.")
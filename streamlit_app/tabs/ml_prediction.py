@@ -1,11 +1,14 @@
 import streamlit as st
+import os
 import pickle
 import numpy as np
 import pandas as pd
 from sklearn.preprocessing import StandardScaler
 import matplotlib.pyplot as plt
+from ML.models.tree_compiler import CompiledTreeEnsemble
 
 MODEL_PATH = "models/lightgbm.pkl"
+COMPILED_MODEL_PATH = "models/lightgbm_compiled.npz"
 TRAINED_FEATURES = [
     "power_tfr_morlet",
     "power_psd_welch",
@@ -54,6 +57,24 @@ def load_model(path):
         st.error(f"Error loading model: {e}")
         return None
 
+@st.cache_resource(show_spinner=False, max_entries=4)
+def load_compiled_model(path, compiled_mtime, model_mtime):
+    # Both modification times are part of the cache key. A compiled model
+    # older than the booster was exported from a previous training run and
+    # is not used.
+    if compiled_mtime < model_mtime:
+        return None
+    try:
+        return CompiledTreeEnsemble.load(path)
+    except Exception as e:
+        st.warning(f"Compiled model could not be loaded, falling back to the LightGBM booster: {e}")
+        return None
+
+def get_compiled_model(path, model_path):
+    if not os.path.exists(path):
+        return None
+    return load_compiled_model(path, os.path.getmtime(path), os.path.getmtime(model_path))
+
 def plot_feature_importance(model, features):
     importance = model.feature_importance()
     importance_df = pd.DataFrame({
@@ -68,15 +89,33 @@ def plot_feature_importance(model, features):
     plt.title("Feature Importance")
     st.pyplot(plt)
 
-def plot_feature_contributions(feature_vector, feature_names):
-    contributions = pd.DataFrame({
-        "Feature": feature_names,
-        "Value": feature_vector.flatten(),
-    }).sort_values(by="Value", ascending=False)
+@st.cache_data(show_spinner=False, max_entries=32)
+def compute_feature_contributions(model_path, model_mtime, feature_row):
+    # model_mtime is part of the cache key so a retrained model invalidates
+    # the cached explanations for every recording. `feature_row` is the single
+    # row the prediction is made from, so the contributions add up to its score.
+    model = load_model(model_path)
+    if model is None:
+        return None
+    if type(model).__module__.split(".")[0] == "xgboost":
+        import xgboost as xgb
+        contributions = model.predict(
+            xgb.DMatrix(feature_row, feature_names=feature_row.columns.tolist()), pred_contribs=True
+        )
+    else:
+        contributions = model.predict(feature_row.to_numpy(), pred_contrib=True)
+    # The last column holds the expected value (bias term) of the model.
+    return pd.DataFrame(
+        {"Contribution": contributions[0, :-1]}, index=feature_row.columns
+    ).assign(ExpectedValue=float(contributions[0, -1]))
+
+def plot_feature_contributions(contributions):
+    contributions = contributions.sort_values(by="Contribution")
 
     plt.figure(figsize=(10, 6))
-    plt.barh(contributions["Feature"], contributions["Value"], color="orange")
-    plt.xlabel("Contribution")
+    colors = ["tab:red" if value > 0 else "tab:blue" for value in contributions["Contribution"]]
+    plt.barh(contributions.index, contributions["Contribution"], color=colors)
+    plt.xlabel("Contribution to log-odds of POST (TreeSHAP)")
     plt.ylabel("Feature")
     plt.title("Feature Contributions to Prediction")
     st.pyplot(plt)
@@ -141,12 +180,18 @@ def render():
             st.subheader("Normalized Features")
             st.dataframe(features.style.format("{:.12g}"))
 
-            feature_vector = features.iloc[0].values.reshape(1, -1)
+            # The prediction and its explanation are both for the first row.
+            feature_row = features.iloc[[0]]
+            feature_vector = feature_row.to_numpy()
 
             st.info("Making predictions...")
             try:
-                prediction = model.predict(feature_vector)[0]
-                probability = model.predict(feature_vector, raw_score=False)[0]
+                compiled_model = get_compiled_model(COMPILED_MODEL_PATH, MODEL_PATH)
+                if compiled_model is not None:
+                    probability = compiled_model.predict_proba(feature_vector)[0]
+                else:
+                    probability = model.predict(feature_vector, raw_score=False)[0]
+                prediction = int(probability > 0.5)
 
                 st.subheader("Prediction Result")
                 if prediction == 1:
@@ -158,7 +203,16 @@ def render():
                 st.dataframe(features.style.format("{:.12g}"))
 
                 st.subheader("Feature Contributions to Prediction")
-                plot_feature_contributions(feature_vector, TRAINED_FEATURES)
+                contributions = compute_feature_contributions(
+                    MODEL_PATH, os.path.getmtime(MODEL_PATH), feature_row
+                )
+                if contributions is not None:
+                    st.caption(
+                        f"For the row the prediction is made from. Model expected value "
+                        f"{contributions['ExpectedValue'].iloc[0]:.4f} plus the contributions gives its log-odds."
+                    )
+                    plot_feature_contributions(contributions)
+                    st.dataframe(contributions.drop(columns="ExpectedValue").style.format("{:.6g}"))
 
             except Exception as e:
                 st.error(f"Error during prediction: {e}")
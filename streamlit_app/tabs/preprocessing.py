@@ -1,10 +1,52 @@
 import streamlit as st
 from pathlib import Path
 import matplotlib
-from utils.visualization import plot_raw, plot_psd, plot_ica_components, plot_ica_overlay
-from preprocessing.preprocessing import PREPROCESSING_METHODS
+import mne
+from utils.visualization import plot_raw
+from preprocessing.preprocessing import run_step, step_figures, take_checkpoint
+from preprocessing.pipeline_cache import EXPORT_FORMATS, cached_export, processing_graph_hash
+from utils.recording_cache import hash_bytes
 matplotlib.use("Agg")
 
+EXPORT_DIR = Path("./temp/exports")
+
+
+def plot_checkpoint(checkpoint):
+    if isinstance(checkpoint, mne.time_frequency.Spectrum):
+        return checkpoint.plot(picks="eeg", show=False)
+    return plot_raw(checkpoint)
+
+
+def render_downloads(processed_raw, graph_hash):
+    # Exports this session asked for and has not downloaded yet. A download
+    # button copies its file into Streamlit's media store on every run that
+    # draws it, so it is only drawn between "Prepare" and the download.
+    requested = st.session_state.setdefault("requested_exports", set())
+    for fmt, file_name in EXPORT_FORMATS.items():
+        label = f".{fmt}"
+        if (graph_hash, fmt) not in requested:
+            if not st.button(f"Prepare {label} download", key=f"prepare_{fmt}"):
+                continue
+            requested.add((graph_hash, fmt))
+        with st.spinner(f"Exporting {label}..."):
+            try:
+                path = cached_export(processed_raw, graph_hash, fmt, EXPORT_DIR)
+                data = path.read_bytes()
+            except Exception as e:
+                st.error(f"Failed to export {label}: {e}")
+                requested.discard((graph_hash, fmt))
+                continue
+        st.download_button(
+            label=f"Download as {label}",
+            data=data,
+            file_name=file_name,
+            mime="application/octet-stream",
+            key=f"download_{fmt}",
+            on_click=requested.discard,
+            args=((graph_hash, fmt),),
+        )
+
+
 def render():
     st.title("Preprocessing")
     st.subheader("Choose Preprocessing Steps")
@@ -21,7 +63,13 @@ def render():
             "Target Sampling Frequency (Hz):", min_value=1, max_value=1000, value=250, step=1,
             help="The target sampling frequency for the EEG data."
         )
-        preprocessing_steps.append({"method": "downsample", "params": {"target_sfreq": target_sfreq}})
+        resample_method = st.selectbox(
+            "Resampling Method:", ["fft", "polyphase"],
+            help="FFT resampling over the whole signal, or a faster polyphase rational resampler."
+        )
+        preprocessing_steps.append(
+            {"method": "downsample", "params": {"target_sfreq": target_sfreq, "method": resample_method}}
+        )
 
     if st.checkbox("Apply Notch Filter"):
         freqs_input = st.text_input(
@@ -59,6 +107,7 @@ def render():
             return
 
         processed_raw = raw_initial.copy()
+        failed = []
 
         for step in preprocessing_steps:
             method = step["method"]
@@ -66,61 +115,49 @@ def render():
 
             st.markdown(f"### Visualization for {method.replace('_', ' ').capitalize()}")
             try:
-                raw_before = processed_raw.copy()
+                # Steps run in place on the session's working copy; only small
+                # checkpoints are kept for the before/after views.
+                before = take_checkpoint(processed_raw, method)
+                result, stats = run_step(processed_raw, method, params, trace_memory=True)
                 if method == "apply_ica":
-                    raw_ica = processed_raw.copy()
-                    processed_raw, fig, fig2 = PREPROCESSING_METHODS[method](raw_ica, **params)
-                    st.pyplot(fig)
-                    st.pyplot(fig2)
+                    processed_raw, ica = result
+                    st.session_state["ica"] = ica
+                    for fig in step_figures(method, ica, before):
+                        st.pyplot(fig)
                 else:
-                    processed_raw = PREPROCESSING_METHODS[method](processed_raw, **params)
+                    processed_raw = result
+                after = take_checkpoint(processed_raw, method)
 
                 col1, col2 = st.columns(2)
                 with col1:
                     st.markdown("#### Before")
-                    if method in ["apply_notch_filter", "apply_bandpass_filter"]:
-                        st.pyplot(plot_psd(raw_before))
-                    else:
-                        st.pyplot(plot_raw(raw_before))
+                    st.pyplot(plot_checkpoint(before))
                 with col2:
                     st.markdown("#### After")
-                    if method in ["apply_notch_filter", "apply_bandpass_filter"]:
-                        st.pyplot(plot_psd(processed_raw))
-                    else:
-                        st.pyplot(plot_raw(processed_raw))
+                    st.pyplot(plot_checkpoint(after))
+                st.caption(
+                    f"{stats['seconds']:.1f}s, peak memory {stats['peak_bytes'] / 1024 ** 2:.1f} MiB "
+                    f"(recording {stats['data_bytes'] / 1024 ** 2:.1f} MiB)"
+                )
 
                 st.success(f"{method.replace('_', ' ').capitalize()} applied successfully.")
             except Exception as e:
                 st.error(f"Failed to apply {method.replace('_', ' ').capitalize()}: {e}")
+                failed.append(method)
+
+        if failed:
+            # The result does not match the selected graph, so it must not be
+            # exported (and cached) under that graph's hash.
+            st.session_state.pop("processed_raw", None)
+            st.session_state.pop("processed_graph_hash", None)
+            st.error(f"Preprocessing incomplete, no download offered. Failed steps: {', '.join(failed)}.")
+            return
 
+        input_hash = st.session_state.get("recording_hash") or hash_bytes(raw_initial.get_data().tobytes())
         st.session_state["processed_raw"] = processed_raw
+        st.session_state["processed_graph_hash"] = processing_graph_hash(input_hash, preprocessing_steps)
         st.success("All selected preprocessing steps applied successfully.")
 
     if "processed_raw" in st.session_state:
         st.markdown("### Download Preprocessed File")
-        processed_raw = st.session_state["processed_raw"]
-        temp_dir = Path("./temp")
-        temp_dir.mkdir(parents=True, exist_ok=True)
-        edf_file = temp_dir / "preprocessed_file.edf"
-        fif_file = temp_dir / "preprocessed_file.fif"
-
-        processed_raw.export(str(edf_file), fmt="EDF", overwrite=True)
-        processed_raw.save(str(fif_file), overwrite=True)
-
-        with open(edf_file, "rb") as f:
-            edf_data = f.read()
-            st.download_button(
-                label="Download as .edf",
-                data=edf_data,
-                file_name=edf_file.name,
-                mime="application/octet-stream",
-            )
-
-        with open(fif_file, "rb") as f:
-            fif_data = f.read()
-            st.download_button(
-                label="Download as .fif",
-                data=fif_data,
-                file_name=fif_file.name,
-                mime="application/octet-stream",
-            )
+        render_downloads(st.session_state["processed_raw"], st.session_state["processed_graph_hash"])
@@ -3,16 +3,34 @@ import os
 import mne
 import tempfile
 import subprocess
+from utils.recording_cache import RecordingCache, hash_bytes
 
 
-def save_uploaded_file_to_tempfile(uploaded_file):
+@st.cache_resource
+def get_recording_cache():
+    return RecordingCache()
+
+
+def save_uploaded_file_to_tempfile(uploaded_file, content_hash=None):
     temp_dir = tempfile.gettempdir()
-    temp_file_path = os.path.join(temp_dir, uploaded_file.name)
+    file_name = f"{content_hash[:16]}_{uploaded_file.name}" if content_hash else uploaded_file.name
+    temp_file_path = os.path.join(temp_dir, file_name)
+    if content_hash and os.path.exists(temp_file_path):
+        return temp_file_path
     with open(temp_file_path, "wb") as temp_file:
         temp_file.write(uploaded_file.getbuffer())
     return temp_file_path
 
 
+def uploaded_file_hash(uploaded_file):
+    # Reruns hand back the same upload, so hash its bytes once per session.
+    hashes = st.session_state.setdefault("upload_hashes", {})
+    upload_key = (getattr(uploaded_file, "file_id", None), uploaded_file.name, uploaded_file.size)
+    if upload_key not in hashes:
+        hashes[upload_key] = hash_bytes(uploaded_file.getbuffer())
+    return hashes[upload_key]
+
+
 def convert_edf_to_fif(edf_file_path, output_dir):
     try:
         raw = mne.io.read_raw_edf(edf_file_path, preload=True)
@@ -44,22 +62,19 @@ def render():
         if uploaded_file:
             st.success(f"Uploaded file: {uploaded_file.name}")
             try:
-                temp_file_path = save_uploaded_file_to_tempfile(uploaded_file)
-                st.session_state.temp_file_path = temp_file_path
-                st.session_state.current_file_name = uploaded_file.name  # Update file name
-
-                if uploaded_file.name.endswith(".fif"):
-                    raw = mne.io.read_raw_fif(temp_file_path, preload=True)
-                elif uploaded_file.name.endswith(".edf"):
-                    raw = mne.io.read_raw_edf(temp_file_path, preload=True)
-                else:
+                if not uploaded_file.name.endswith((".fif", ".edf")):
                     st.error("Unsupported file format.")
                     return
 
-                montage = mne.channels.make_standard_montage("standard_1020")
-                raw.set_montage(montage)
+                content_hash = uploaded_file_hash(uploaded_file)
+                temp_file_path = save_uploaded_file_to_tempfile(uploaded_file, content_hash)
+                st.session_state.temp_file_path = temp_file_path
+                st.session_state.current_file_name = uploaded_file.name  # Update file name
+
+                raw = get_recording_cache().get_or_load(content_hash, temp_file_path)
 
                 st.session_state.raw_initial = raw
+                st.session_state.recording_hash = content_hash
                 st.success("EEG file loaded successfully.")
             except Exception as e:
                 st.error(f"Failed to load file: {e}")
@@ -76,18 +91,12 @@ def render():
             st.session_state.temp_file_path = file_path
             st.session_state.current_file_name = selected_file  # Update file name
             try:
-                if file_path.endswith(".fif"):
-                    raw = mne.io.read_raw_fif(file_path, preload=True)
-                elif file_path.endswith(".edf"):
-                    raw = mne.io.read_raw_edf(file_path, preload=True)
-                else:
-                    st.error("Unsupported file format.")
-                    return
-
-                montage = mne.channels.make_standard_montage("standard_1020")
-                raw.set_montage(montage)
+                recording_cache = get_recording_cache()
+                content_hash = recording_cache.key_for_file(file_path)
+                raw = recording_cache.get_or_load(content_hash, file_path)
 
                 st.session_state.raw_initial = raw
+                st.session_state.recording_hash = content_hash
                 st.success("Preloaded file loaded successfully.")
             except Exception as e:
                 st.error(f"Failed to load preloaded file: {e}")
@@ -1,6 +1,7 @@
 import streamlit as st
+from utils.trace_pyramid import PyramidCache
 from utils.visualization import (
-    plot_raw,
+    plot_raw_webgl,
     plot_psd,
     plot_ica_components,
     plot_ica_overlay,
@@ -11,6 +12,31 @@ from utils.visualization import (
 )
 import mne
 
+
+@st.cache_resource
+def get_pyramid_cache():
+    return PyramidCache()
+
+
+def render_raw_viewer(raw):
+    with st.spinner("Building trace overview..."):
+        pyramid = get_pyramid_cache().get_or_build(st.session_state.get("recording_hash") or id(raw), raw)
+    max_duration = max(1.0, float(pyramid.duration))
+    duration = st.select_slider(
+        "Window (s)",
+        options=[d for d in (1, 2, 5, 10, 30, 60, 300, 600, 1800, 3600) if d < max_duration] + [max_duration],
+        value=min(10, max_duration),
+    )
+    tmin = st.slider("Start (s)", 0.0, max(0.0, max_duration - duration), 0.0, step=max(duration / 10, 0.1))
+    channels = st.multiselect("Channels", pyramid.ch_names, default=pyramid.ch_names)
+    picks = [pyramid.ch_names.index(channel) for channel in channels]
+    if not picks:
+        st.info("Select at least one channel.")
+        return
+    fig = plot_raw_webgl(pyramid, raw, tmin=tmin, duration=duration, picks=picks, height=max(300, 14 * len(picks)))
+    st.plotly_chart(fig, use_container_width=True)
+
+
 def render():
     st.title("EEG Visualization")
 
@@ -23,8 +49,7 @@ def render():
 
     if st.sidebar.checkbox("Plot Raw Signals"):
         st.subheader("Raw EEG Signals")
-        fig = plot_raw(raw)
-        st.pyplot(fig)
+        render_raw_viewer(raw)
 
     if st.sidebar.checkbox("Plot Power Spectral Density (PSD)"):
         st.subheader("Power Spectral Density")
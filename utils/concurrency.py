@@ -0,0 +1,69 @@
+import os
+
+from utils.logger_manager import LoggerManager
+
+logger = LoggerManager.get_logger("Concurrency")
+
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+# Set inside configured workers; library calls read it through stage_n_jobs().
+JOBS_ENV_VAR = "EEG_STAGE_JOBS"
+
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def stage_cores(stage):
+    # Every stage may use the whole machine unless EEG_CORES_<STAGE> (for
+    # example EEG_CORES_FEATURES=8) gives it a smaller budget.
+    value = os.environ.get(f"EEG_CORES_{stage.upper()}")
+    cores = available_cores()
+    return max(1, min(int(value), cores)) if value else cores
+
+
+def plan_parallelism(stage, n_items, max_workers=None):
+    # Per-file parallelism while there are enough files to fill the budget;
+    # cores left over go to per-channel n_jobs inside each worker. Returns
+    # (number of workers, n_jobs per worker) with workers * n_jobs <= budget.
+    cores = stage_cores(stage)
+    workers = max(1, min(n_items, cores, max_workers or cores))
+    n_jobs = max(1, cores // workers)
+    logger.info(f"{stage}: {workers} workers x {n_jobs} threads on a {cores}-core budget")
+    return workers, n_jobs
+
+
+def pin_threads(n_threads):
+    # Environment variables cover libraries loaded later; threadpoolctl
+    # resizes the BLAS/OpenMP pools numpy and scipy have already started.
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(n_threads)
+    os.environ[JOBS_ENV_VAR] = str(n_threads)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=n_threads)
+    except ImportError:
+        pass
+
+
+def configure_worker(n_jobs):
+    # Initializer for ProcessPoolExecutor / joblib workers.
+    pin_threads(n_jobs)
+
+
+def stage_n_jobs(n_jobs=None):
+    # n_jobs for mne/joblib calls: an explicit value wins, then the budget of
+    # the configured worker this runs in, then every available core.
+    if n_jobs is not None:
+        return n_jobs
+    value = os.environ.get(JOBS_ENV_VAR)
+    return int(value) if value else available_cores()
@@ -0,0 +1,116 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import mne
+from utils.logger_manager import LoggerManager
+from utils.recording_store import STORE_SUFFIX, StoredRecording
+
+logger = LoggerManager.get_logger("RecordingCache")
+
+DEFAULT_MAX_BYTES = 4 * 1024 ** 3
+HASH_CHUNK_SIZE = 8 * 1024 ** 2
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    # Array stores are directories; hash their files in a fixed order.
+    paths = sorted(p for p in Path(path).rglob("*") if p.is_file()) if os.path.isdir(path) else [path]
+    for file_path in paths:
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_recording(path, montage="standard_1020"):
+    if str(path).rstrip("/").endswith(STORE_SUFFIX):
+        raw = StoredRecording(path).to_raw()
+    elif str(path).endswith(".fif"):
+        raw = mne.io.read_raw_fif(path, preload=True)
+    elif str(path).endswith(".edf"):
+        raw = mne.io.read_raw_edf(path, preload=True)
+    else:
+        raise ValueError(f"Unsupported file format: {path}")
+    if montage:
+        raw.set_montage(mne.channels.make_standard_montage(montage))
+    return raw
+
+
+class RecordingCache:
+    # Decoded recordings keyed by content hash, shared by every session of the
+    # app. Entries are evicted least-recently-used once their preloaded data
+    # exceeds max_bytes. Cached Raw objects are shared, so callers must copy
+    # before modifying them.
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._file_keys = {}
+        self._lock = threading.Lock()
+        self._loading = {}
+
+    @property
+    def total_bytes(self):
+        return sum(self._sizes.values())
+
+    def key_for_file(self, path):
+        # Hashing a large file on every rerun is wasteful, so remember the hash
+        # for as long as the file's size and mtime do not change.
+        stat = os.stat(path)
+        signature = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            key = self._file_keys.get(signature)
+        if key is None:
+            key = hash_file(path)
+            with self._lock:
+                self._file_keys[signature] = key
+        return key
+
+    def get(self, key):
+        with self._lock:
+            raw = self._entries.get(key)
+            if raw is not None:
+                self._entries.move_to_end(key)
+            return raw
+
+    def get_or_load(self, key, path, montage="standard_1020"):
+        raw = self.get(key)
+        if raw is not None:
+            logger.info(f"Recording cache hit for {os.path.basename(str(path))}")
+            return raw
+
+        with self._lock:
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        # Only one session decodes a given recording; the others wait for it.
+        with key_lock:
+            raw = self.get(key)
+            if raw is None:
+                logger.info(f"Decoding {path} into the recording cache")
+                raw = load_recording(path, montage=montage)
+                self._put(key, raw)
+        with self._lock:
+            self._loading.pop(key, None)
+        return raw
+
+    def _put(self, key, raw):
+        size = raw._data.nbytes
+        with self._lock:
+            self._entries[key] = raw
+            self._sizes[key] = size
+            self._entries.move_to_end(key)
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                evicted, _ = self._entries.popitem(last=False)
+                self._sizes.pop(evicted)
+                logger.info(f"Evicted recording {evicted[:12]} from the recording cache")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
@@ -0,0 +1,148 @@
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import mne
+import numpy as np
+
+from utils.logger_manager import LoggerManager
+
+logger = LoggerManager.get_logger("RecordingStore")
+
+STORE_SUFFIX = ".eegstore"
+DATA_FILE = "data.npy"
+META_FILE = "meta.json"
+CHUNK_SECONDS = 60
+OUTPUT_FORMATS = ("edf", "fif", "store")
+
+
+class StoredRecording:
+    # A recording saved as a float32 (channels x times) array plus metadata.
+    # get_data() returns views of a read-only memory map, so extractors that
+    # only need the samples, sfreq and channel names read them without
+    # decoding or copying. to_raw() builds a regular mne Raw when the full API
+    # is needed.
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / META_FILE) as f:
+            self.meta = json.load(f)
+        self._data = np.load(self.path / DATA_FILE, mmap_mode="r")
+        self.info = mne.create_info(self.meta["ch_names"], self.meta["sfreq"], self.meta["ch_types"])
+        with self.info._unlock():
+            self.info["highpass"] = self.meta["highpass"]
+            self.info["lowpass"] = self.meta["lowpass"]
+
+    @property
+    def ch_names(self):
+        return self.info["ch_names"]
+
+    @property
+    def n_times(self):
+        return self._data.shape[1]
+
+    def get_data(self, picks=None, start=0, stop=None):
+        data = self._data[:, start:stop]
+        if picks is None:
+            return data
+        if isinstance(picks, str):
+            picks = [picks]
+        indices = [self.ch_names.index(pick) if isinstance(pick, str) else pick for pick in picks]
+        return data[indices]
+
+    def to_raw(self):
+        raw = mne.io.RawArray(self._data, self.info.copy(), verbose=False)
+        annotations = self.meta.get("annotations")
+        if annotations and annotations["onset"]:
+            raw.set_annotations(mne.Annotations(**annotations))
+        return raw
+
+
+def store_path(output_dir, base_name, suffix):
+    return Path(output_dir) / f"{base_name}_{suffix}{STORE_SUFFIX}"
+
+
+def save_store(raw, path, chunk_seconds=CHUNK_SECONDS):
+    # Written chunk by chunk into a memory-mapped .npy, so converting to
+    # float32 never holds a second full copy of the recording.
+    path = Path(path)
+    partial = path.with_name(f"partial_{os.getpid()}_{path.name}")
+    shutil.rmtree(partial, ignore_errors=True)
+    partial.mkdir(parents=True)
+    n_channels, n_times = len(raw.ch_names), int(raw.n_times)
+    out = np.lib.format.open_memmap(partial / DATA_FILE, mode="w+", dtype=np.float32, shape=(n_channels, n_times))
+    chunk = max(1, int(chunk_seconds * raw.info["sfreq"]))
+    for start in range(0, n_times, chunk):
+        out[:, start:start + chunk] = raw.get_data(start=start, stop=start + chunk)
+    out.flush()
+    del out
+
+    meta = {
+        "sfreq": raw.info["sfreq"],
+        "ch_names": raw.ch_names,
+        "ch_types": raw.get_channel_types(),
+        "highpass": raw.info["highpass"],
+        "lowpass": raw.info["lowpass"],
+        "first_samp": int(raw.first_samp),
+        "annotations": {
+            "onset": [float(onset) for onset in raw.annotations.onset],
+            "duration": [float(duration) for duration in raw.annotations.duration],
+            "description": list(raw.annotations.description),
+        },
+    }
+    with open(partial / META_FILE, "w") as f:
+        json.dump(meta, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(partial, path)
+    return path
+
+
+def read_recording(path):
+    # Stores come back as StoredRecording (zero-copy); EDF/FIF as mne Raw.
+    path = str(path)
+    if path.rstrip("/").endswith(STORE_SUFFIX):
+        return StoredRecording(path)
+    if path.endswith(".fif"):
+        return mne.io.read_raw_fif(path, preload=True)
+    return mne.io.read_raw_edf(path, preload=True)
+
+
+def is_recording_file(name):
+    return name.endswith((".edf", ".fif", STORE_SUFFIX))
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    sfreq, n_channels, seconds = 250.0, 64, 1800
+    rng = np.random.default_rng(0)
+    info = mne.create_info(n_channels, sfreq, "eeg")
+    raw = mne.io.RawArray(rng.standard_normal((n_channels, int(sfreq * seconds))) * 1e-5, info, verbose=False)
+    megabytes = raw._data.nbytes / 1024 ** 2
+    out_dir = Path(tempfile.mkdtemp())
+
+    writers = {
+        "edf": (lambda: raw.export(out_dir / "bench.edf", fmt="EDF", overwrite=True, verbose=False),
+                lambda: mne.io.read_raw_edf(out_dir / "bench.edf", preload=True, verbose=False).get_data()),
+        "fif": (lambda: raw.save(out_dir / "bench_raw.fif", overwrite=True, verbose=False),
+                lambda: mne.io.read_raw_fif(out_dir / "bench_raw.fif", preload=True, verbose=False).get_data()),
+        "store": (lambda: save_store(raw, out_dir / f"bench{STORE_SUFFIX}"),
+                  lambda: np.asarray(StoredRecording(out_dir / f"bench{STORE_SUFFIX}").get_data()).sum()),
+    }
+    for name, (write, read) in writers.items():
+        try:
+            start = time.perf_counter()
+            write()
+            write_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            read()
+            read_seconds = time.perf_counter() - start
+        except Exception as e:
+            logger.warning(f"{name}: skipped ({e.__class__.__name__}: {str(e).splitlines()[0]})")
+            continue
+        logger.info(
+            f"{name}: write {megabytes / write_seconds:.0f} MiB/s, read {megabytes / read_seconds:.0f} MiB/s "
+            f"({megabytes:.0f} MiB of float64 samples)"
+        )
+    shutil.rmtree(out_dir, ignore_errors=True)
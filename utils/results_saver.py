@@ -1,6 +1,8 @@
 import pandas as pd
 import json
 import os
+from contextlib import contextmanager
+from pathlib import Path
 import numpy as np
 import h5py
 
@@ -36,3 +38,29 @@ def save_to_hdf5(data, filepath, metadata=None):
         print(f"Saved data to HDF5: {filepath}")
     except Exception as e:
         print(f"Error saving to HDF5 {filepath}: {e}")
+
+@contextmanager
+def array_writer(filepath, shape, dtype="float64", metadata=None):
+    # Yields an array to fill block by block: an HDF5 dataset for .hdf5 paths,
+    # otherwise a memory-mapped .npy. The file only appears under its final
+    # name once the block has completed.
+    filepath = Path(filepath)
+    partial = filepath.with_name(f"partial_{os.getpid()}_{filepath.name}")
+    try:
+        if filepath.suffix == ".hdf5":
+            with h5py.File(partial, "w") as hdf5_file:
+                dataset = hdf5_file.create_dataset("data", shape=shape, dtype=dtype)
+                for key, value in (metadata or {}).items():
+                    hdf5_file.attrs[key] = value
+                yield dataset
+        else:
+            out = np.lib.format.open_memmap(partial, mode="w+", dtype=dtype, shape=tuple(int(n) for n in shape))
+            yield out
+            out.flush()
+            del out
+    except BaseException:
+        if partial.exists():
+            partial.unlink()
+        raise
+    os.replace(partial, filepath)
+    print(f"Saved data to {filepath.suffix[1:].upper()}: {filepath}")
@@ -0,0 +1,140 @@
+import threading
+from collections import OrderedDict
+
+import mne
+import numpy as np
+
+from utils.logger_manager import LoggerManager
+
+logger = LoggerManager.get_logger("TracePyramid")
+
+DEFAULT_MAX_BYTES = 512 * 1024 ** 2
+# Samples read from the Raw per block while building the first level.
+BUILD_CHUNK_SAMPLES = 1024 ** 2
+
+
+class MinMaxPyramid:
+    # Per-channel min/max envelopes of a recording at bucket sizes factor**k,
+    # k >= 1. Drawing the min and max of every bucket keeps spikes and
+    # artifacts visible at any zoom level while only ~2 points per pixel are
+    # sent to the browser. The samples themselves are not copied: windows
+    # short enough to need them are read from the Raw passed to window().
+    def __init__(self, raw, picks, factor=4, min_buckets=512):
+        self.sfreq = float(raw.info["sfreq"])
+        self.picks = np.asarray(picks)
+        self.ch_names = [raw.ch_names[pick] for pick in self.picks]
+        self.factor = factor
+        self.n_times = raw.n_times
+        self.bucket_sizes = [1]
+        self.mins = [None]
+        self.maxs = [None]
+
+        # The first level and the channel scales are computed block by block,
+        # so the recording is never copied as a whole.
+        chunk = max(factor, BUILD_CHUNK_SAMPLES // factor * factor)
+        level_min, level_max = [], []
+        sums = np.zeros(len(self.picks))
+        squares = np.zeros(len(self.picks))
+        for start in range(0, self.n_times, chunk):
+            block = raw.get_data(picks=self.picks, start=start, stop=start + chunk)
+            sums += block.sum(axis=1)
+            squares += np.einsum("ij,ij->i", block, block)
+            if self.n_times > min_buckets * factor:
+                level_min.append(self._reduce(block, np.minimum).astype(np.float32))
+                level_max.append(self._reduce(block, np.maximum).astype(np.float32))
+        variance = np.maximum(squares / self.n_times - (sums / self.n_times) ** 2, 0)
+        self.scale = np.maximum(np.sqrt(variance), np.finfo(np.float32).tiny).astype(np.float32)
+        if not level_min:
+            return
+
+        level_min, level_max = np.concatenate(level_min, axis=1), np.concatenate(level_max, axis=1)
+        self.bucket_sizes.append(factor)
+        self.mins.append(level_min)
+        self.maxs.append(level_max)
+        while level_min.shape[1] > min_buckets * factor:
+            level_min = self._reduce(level_min, np.minimum)
+            level_max = self._reduce(level_max, np.maximum)
+            self.bucket_sizes.append(self.bucket_sizes[-1] * factor)
+            self.mins.append(level_min)
+            self.maxs.append(level_max)
+
+    @classmethod
+    def from_raw(cls, raw, **kwargs):
+        indices = mne.pick_types(raw.info, eeg=True, exclude=[])
+        if len(indices) == 0:
+            indices = np.arange(len(raw.ch_names))
+        return cls(raw, indices, **kwargs)
+
+    def _reduce(self, values, reducer):
+        n_buckets = -(-values.shape[1] // self.factor)
+        padding = n_buckets * self.factor - values.shape[1]
+        if padding:
+            values = np.concatenate([values, np.repeat(values[:, -1:], padding, axis=1)], axis=1)
+        # Elementwise reduction over strided slices is several times faster than
+        # reducing a short trailing axis of a reshaped view.
+        reduced = values[:, 0::self.factor].copy()
+        for offset in range(1, self.factor):
+            reducer(reduced, values[:, offset::self.factor], out=reduced)
+        return reduced
+
+    @property
+    def duration(self):
+        return self.n_times / self.sfreq
+
+    @property
+    def nbytes(self):
+        return sum(level.nbytes for level in self.mins[1:] + self.maxs[1:]) + self.scale.nbytes
+
+    def window(self, raw, tmin, tmax, n_pixels=1500, picks=None):
+        # `raw` is the recording the pyramid was built from; it is only read
+        # when the window is short enough to draw every sample.
+        start = max(0, int(tmin * self.sfreq))
+        stop = min(self.n_times, max(start + 1, int(np.ceil(tmax * self.sfreq))))
+        picks = np.arange(len(self.picks)) if picks is None else np.asarray(picks)
+
+        # Coarsest level that still gives at least one bucket per pixel.
+        samples_per_pixel = (stop - start) / max(n_pixels, 1)
+        level = 0
+        while level + 1 < len(self.bucket_sizes) and self.bucket_sizes[level + 1] <= samples_per_pixel:
+            level += 1
+        bucket = self.bucket_sizes[level]
+
+        first, last = start // bucket, -(-stop // bucket)
+        if level == 0:
+            times = np.arange(first, last) / self.sfreq
+            return times, raw.get_data(picks=self.picks[picks], start=first, stop=last)
+
+        bucket_times = np.arange(first, last) * bucket / self.sfreq
+        lows = self.mins[level][picks, first:last]
+        highs = self.maxs[level][picks, first:last]
+        values = np.stack([lows, highs], axis=-1).reshape(lows.shape[0], -1)
+        return np.repeat(bucket_times, 2), values
+
+
+class PyramidCache:
+    # Trace pyramids keyed by recording hash, shared by every session of the
+    # app and evicted least-recently-used once they exceed max_bytes, like
+    # the RecordingCache their recordings live in.
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def total_bytes(self):
+        return sum(pyramid.nbytes for pyramid in self._entries.values())
+
+    def get_or_build(self, key, raw):
+        with self._lock:
+            pyramid = self._entries.get(key)
+            if pyramid is not None:
+                self._entries.move_to_end(key)
+                return pyramid
+        pyramid = MinMaxPyramid.from_raw(raw)
+        with self._lock:
+            self._entries[key] = pyramid
+            self._entries.move_to_end(key)
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                evicted, _ = self._entries.popitem(last=False)
+                logger.info(f"Evicted trace pyramid {str(evicted)[:12]} from the pyramid cache")
+        return pyramid
@@ -10,6 +10,42 @@ def plot_raw(raw):
     fig = raw.plot(show=False, block=False)
     return fig
 
+def plot_raw_webgl(pyramid, raw, tmin=0.0, duration=10.0, n_pixels=1500, picks=None, height=900):
+    # Draws only the visible window, decimated to screen resolution, with one
+    # WebGL trace per channel stacked on a common axis. `raw` is the recording
+    # the pyramid was built from.
+    import plotly.graph_objects as go
+
+    tmax = min(tmin + duration, pyramid.duration)
+    picks = np.arange(len(pyramid.ch_names)) if picks is None else np.asarray(picks)
+    times, values = pyramid.window(raw, tmin, tmax, n_pixels=n_pixels, picks=picks)
+
+    offsets = np.arange(len(picks))[::-1]
+    fig = go.Figure()
+    for row, channel in enumerate(picks):
+        fig.add_trace(go.Scattergl(
+            x=times,
+            y=values[row] / (6 * pyramid.scale[channel]) + offsets[row],
+            mode="lines",
+            line={"width": 1},
+            name=pyramid.ch_names[channel],
+            hoverinfo="name+x",
+        ))
+    fig.update_layout(
+        height=height,
+        showlegend=False,
+        margin={"l": 60, "r": 10, "t": 10, "b": 40},
+        xaxis={"title": "Time (s)", "range": [tmin, tmax]},
+        yaxis={
+            "tickmode": "array",
+            "tickvals": offsets,
+            "ticktext": [pyramid.ch_names[channel] for channel in picks],
+            "range": [-1, len(picks)],
+            "fixedrange": True,
+        },
+    )
+    return fig
+
 def plot_psd(raw, fmin=0.5, fmax=99):
     raw.set_montage("standard_1020")
     psd = raw.compute_psd(fmin=fmin, fmax=fmax)